@@ -0,0 +1,102 @@
+"""Микробенчмарк выбора обработчика для кнопок опроса.
+
+Сравнивает прежнюю схему (Filters.regex на каждое обновление и разбор
+текста подстроками в обработчике) с таблицей SurveyRouter из main.py
+(один поиск в словаре по состоянию и точному тексту кнопки):
+    python bench_router.py --rounds 200000
+"""
+import argparse
+import time
+
+from telegram import Update
+from telegram.ext import Filters, MessageHandler
+
+from main import AUTOSTART, AUTOSTART_BUTTONS, CONTROL, CONTROL_BUTTONS, GPS, GPS_BUTTONS, build_router
+
+# Прежние фильтры и разбор ответа в обработчиках (для сравнения с таблицей из main)
+REGEX_HANDLERS = {
+    AUTOSTART: (Filters.regex('^(С автозапуском|БЕЗ автозапуска)$'), lambda text: 1 if text == 'С автозапуском' else 0),
+    CONTROL: (Filters.regex('^(😎 Приложение в телефоне|📺 Брелок)$'), lambda text: 'app' if 'Приложение' in text else 'remote'),
+    GPS: (Filters.regex('^(Да, нужен GPS|Нет, не нужен)$'), lambda text: 1 if 'Да' in text else 0),
+}
+BUTTONS = {
+    AUTOSTART: AUTOSTART_BUTTONS,
+    CONTROL: CONTROL_BUTTONS,
+    GPS: GPS_BUTTONS,
+}
+
+
+def noop(update, context, answer=None):
+    return answer
+
+
+def make_update(update_id, text):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+        },
+    }, None)
+
+
+def make_cases():
+    """Все кнопки плюс произвольный текст, который не должен совпасть"""
+    cases = []
+    for state, buttons in BUTTONS.items():
+        for text in buttons:
+            cases.append((state, make_update(len(cases), text)))
+        cases.append((state, make_update(len(cases), 'какой-то текст')))
+    return cases
+
+
+def bench(dispatch, cases, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for state, update in cases:
+            dispatch(state, update)
+    return (time.perf_counter() - started) / (rounds * len(cases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение Filters.regex и SurveyRouter')
+    parser.add_argument('--rounds', type=int, default=100000)
+    args = parser.parse_args()
+
+    cases = make_cases()
+
+    regex_handlers = {
+        state: (MessageHandler(regex, noop), decode) for state, (regex, decode) in REGEX_HANDLERS.items()
+    }
+
+    def dispatch_regex(state, update):
+        handler, decode = regex_handlers[state]
+        if handler.check_update(update):
+            return decode(update.message.text)
+        return None
+
+    router = build_router()
+    router_handlers = {state: router.handler(state) for state in BUTTONS}
+
+    def dispatch_router(state, update):
+        route = router_handlers[state].check_update(update)
+        if route:
+            return route[1]
+        return None
+
+    # Обе схемы должны расшифровывать ответы одинаково
+    for state, update in cases:
+        assert dispatch_regex(state, update) == dispatch_router(state, update), update.message.text
+
+    before = bench(dispatch_regex, cases, args.rounds)
+    after = bench(dispatch_router, cases, args.rounds)
+    print(f"Filters.regex + подстроки: {before * 1e9:8.0f} нс на обновление")
+    print(f"SurveyRouter:              {after * 1e9:8.0f} нс на обновление")
+    print(f"Ускорение: x{before / after:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import html
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Биты функций системы
+FEATURE_AUTOSTART = 1
+FEATURE_REMOTE = 2
+FEATURE_GSM = 4
+FEATURE_GPS = 8
+ALL_FEATURE_MASKS = range(16)
+
+# Сколько систем показываем в рекомендации
+RECOMMENDATIONS_LIMIT = 2
+
+RECOMMENDATION_HEADER = "Вот отличные варианты для вас:\n\n"
+RECOMMENDATION_FOOTER = (
+    "\nДля подробного обсуждения и оформления заказа оставьте, пожалуйста, ваш номер телефона. "
+    "Наш специалист свяжется с вами в ближайшее время."
+)
+NOTHING_FOUND_TEXT = (
+    "К сожалению, по вашим запросам не найдено подходящих систем. "
+    "Оставьте ваш номер телефона, и наш специалист поможет вам с подбором вручную."
+)
+
+
+def product_mask(product):
+    """Битовая маска функций товара"""
+    mask = 0
+    if product.get('autostart'):
+        mask |= FEATURE_AUTOSTART
+    if product.get('remote'):
+        mask |= FEATURE_REMOTE
+    if product.get('gsm'):
+        mask |= FEATURE_GSM
+    if product.get('gps'):
+        mask |= FEATURE_GPS
+    return mask
+
+
+def required_mask(autostart, control, gps):
+    """Маска обязательных функций по ответам пользователя"""
+    mask = 0
+    if autostart == 1:
+        mask |= FEATURE_AUTOSTART
+    # Управление из приложения возможно только с GSM-модулем
+    if control == 'app':
+        mask |= FEATURE_GSM
+    if gps == 1:
+        mask |= FEATURE_GPS
+    return mask
+
+
+def render_recommendation(products):
+    """Формирует HTML-сообщение с рекомендациями"""
+    if not products:
+        return NOTHING_FOUND_TEXT
+
+    lines = [RECOMMENDATION_HEADER]
+    for prod in products:
+        lines.append(f"• <a href='{html.escape(prod['link'])}'>{html.escape(prod['name'])}</a>\n")
+    lines.append(RECOMMENDATION_FOOTER)
+    return ''.join(lines)
+
+
+def validate_products(products):
+    """Проверяет, что каталог - список товаров с названием и ссылкой; иначе ValueError"""
+    if not isinstance(products, list):
+        raise ValueError(f"catalog must be a list, got {type(products).__name__}")
+    for position, product in enumerate(products):
+        if not isinstance(product, dict):
+            raise ValueError(f"product #{position} must be an object, got {type(product).__name__}")
+        for field in ('name', 'link'):
+            if not isinstance(product.get(field), str):
+                raise ValueError(f"product #{position} has no '{field}'")
+    return products
+
+
+class RecommendationIndex:
+    """Предрасчитанные рекомендации для каждой маски требований.
+
+    Подбор сводится к одному обращению к кортежу по маске, а текст
+    сообщения готовится заранее при построении индекса.
+    """
+
+    def __init__(self, products):
+        self.products = list(products)
+
+        # Ранжирование: сначала по приоритету (если задан), затем по порядку в каталоге
+        ranked = sorted(
+            enumerate(self.products),
+            key=lambda item: (-item[1].get('priority', 0), item[0])
+        )
+        masks = [(product_mask(product), product) for _, product in ranked]
+
+        results = []
+        messages = []
+        for required in ALL_FEATURE_MASKS:
+            matched = [product for mask, product in masks if mask & required == required]
+            top = tuple(matched[:RECOMMENDATIONS_LIMIT])
+            results.append(top)
+            messages.append(render_recommendation(top))
+
+        self._results = tuple(results)
+        self._messages = tuple(messages)
+
+    def __len__(self):
+        return len(self.products)
+
+    def recommend(self, required):
+        """Лучшие товары для маски требований"""
+        return self._results[required]
+
+    def message(self, required):
+        """Готовый текст рекомендации для маски требований"""
+        return self._messages[required]
+
+
+class Catalog:
+    """Текущий индекс каталога с горячей перезагрузкой из JSON-файла.
+
+    Индекс заменяется целиком одной ссылкой, поэтому обработчики
+    всегда видят согласованную версию каталога. Файл проверяется и
+    индекс перестраивается только в фоновом потоке (start_watching),
+    чтение index в обработчике - просто чтение ссылки.
+    """
+
+    def __init__(self, default_products, path=None, check_interval=5.0):
+        self.default_products = default_products
+        self.path = path
+        self.check_interval = check_interval
+
+        self._index = RecommendationIndex(default_products)
+        self._mtime = None
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+        self._stop = None
+        self.maybe_reload(force=True)
+
+    @property
+    def index(self):
+        return self._index
+
+    def replace(self, products):
+        """Атомарно подменяет каталог новым списком товаров"""
+        self._index = RecommendationIndex(products)
+        logger.info("📦 Каталог обновлен: %s товаров", len(self._index))
+
+    def maybe_reload(self, force=False):
+        """Перечитывает файл каталога, если он изменился (не чаще раза в check_interval)"""
+        if not self.path:
+            return False
+
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+
+        try:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime == self._mtime:
+                return False
+
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    products = validate_products(json.load(f))
+                self.replace(products)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error("❌ Не удалось загрузить каталог %s: %s", self.path, e)
+                return False
+            finally:
+                self._mtime = mtime
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def start_watching(self):
+        """Проверяет файл каталога в фоновом потоке раз в check_interval"""
+        if not self.path:
+            return
+        self._stop = threading.Event()
+
+        def loop(stop):
+            while not stop.wait(self.check_interval):
+                try:
+                    self.maybe_reload(force=True)
+                except Exception:
+                    logger.exception("💥 Ошибка перезагрузки каталога")
+
+        threading.Thread(target=loop, args=(self._stop,), name='catalog-watch', daemon=True).start()
+
+    def stop_watching(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
@@ -0,0 +1,224 @@
+"""Фоновая синхронизация каталога со страницами товаров на ya7auto.ru.
+
+Каждая страница запрашивается условным GET (ETag / Last-Modified), из
+измененных страниц извлекаются название, цена и функции системы, а
+результат атомарно записывается в JSON-файл каталога, который бот
+подхватывает горячей перезагрузкой (catalog.Catalog).
+
+Разовый запуск, например против локальных HTML-фикстур:
+    python catalog_sync.py --catalog catalog.json --seed fixtures/seed.json
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (compatible; ya7auto-catalog-sync)'
+
+# Признаки функций в таблице характеристик: ключ -> слова в названии строки
+FEATURE_LABELS = {
+    'autostart': ('автозапуск',),
+    'remote': ('брелок',),
+    'gsm': ('gsm', 'приложени', 'смартфон'),
+    'gps': ('gps', 'глонасс'),
+}
+YES_WORDS = ('да', 'есть', 'yes', '+', '✓')
+NO_WORDS = ('нет', 'no', '-', '—')
+
+PRICE_RE = re.compile(r'(\d[\d\s ]*)')
+
+
+def parse_price(text):
+    match = PRICE_RE.search(text or '')
+    if not match:
+        return None
+    digits = re.sub(r'\D', '', match.group(1))
+    return int(digits) if digits else None
+
+
+def _flag(value):
+    value = value.strip().lower()
+    if value.startswith(YES_WORDS):
+        return 1
+    if value.startswith(NO_WORDS):
+        return 0
+    return None
+
+
+def parse_product_page(html):
+    """Извлекает со страницы товара название, цену и функции (только найденные поля)"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    result = {}
+
+    title = soup.find('h1') or soup.find('meta', property='og:title')
+    if title is not None:
+        name = title.get('content') if title.name == 'meta' else title.get_text(strip=True)
+        if name:
+            result['name'] = name
+
+    price_tag = soup.find(attrs={'itemprop': 'price'}) or soup.find(class_='price')
+    if price_tag is not None:
+        price = parse_price(price_tag.get('content') or price_tag.get_text(' ', strip=True))
+        if price:
+            result['price'] = price
+
+    # Таблица характеристик: строки вида "Автозапуск | Да"
+    for row in soup.find_all(['tr', 'li', 'dl']):
+        cells = [cell.get_text(' ', strip=True) for cell in row.find_all(['th', 'td', 'dt', 'dd', 'span'])]
+        if len(cells) < 2:
+            continue
+        label = cells[0].lower()
+        flag = _flag(cells[-1])
+        if flag is None:
+            continue
+        for feature, words in FEATURE_LABELS.items():
+            if feature not in result and any(word in label for word in words):
+                result[feature] = flag
+
+    return result
+
+
+def write_json_atomic(path, data):
+    """Пишет JSON во временный файл и подменяет им целевой одним rename"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.catalog-', suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class CatalogSync:
+    """Обходит страницы товаров и обновляет файл каталога.
+
+    Валидаторы кеша (ETag, Last-Modified) хранятся рядом с каталогом в
+    <catalog>.http.json, поэтому неизмененные страницы не скачиваются
+    и после перезапуска.
+    """
+
+    def __init__(self, catalog_path, seed_products, workers=4, timeout=(3.05, 15), on_update=None):
+        self.catalog_path = catalog_path
+        self.validators_path = f"{catalog_path}.http.json"
+        self.seed_products = seed_products
+        self.workers = workers
+        self.timeout = timeout
+        self.on_update = on_update
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self._stop = None
+
+    def _load_json(self, path, default):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def _fetch(self, product, validators):
+        """Условный GET страницы: возвращает (обновленный товар или None, новые валидаторы)"""
+        link = product['link']
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.session.get(link, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            return None, validators
+        response.raise_for_status()
+
+        updated = dict(product)
+        updated.update(parse_product_page(response.text))
+        return updated, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+    def run_once(self):
+        """Один проход синхронизации; возвращает количество измененных товаров"""
+        products = self._load_json(self.catalog_path, None) or self.seed_products
+        validators = self._load_json(self.validators_path, {})
+
+        def sync(product):
+            try:
+                return self._fetch(product, validators.get(product['link'], {}))
+            except Exception as e:
+                logger.warning("⚠️ Не удалось обновить %s: %s", product.get('link'), e)
+                return None, validators.get(product['link'], {})
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='catalog-sync') as pool:
+            results = list(pool.map(sync, products))
+
+        changed = 0
+        new_products = []
+        new_validators = {}
+        for product, (updated, page_validators) in zip(products, results):
+            new_validators[product['link']] = page_validators
+            if updated is not None and updated != product:
+                changed += 1
+                new_products.append(updated)
+            else:
+                new_products.append(product)
+
+        if changed or not os.path.exists(self.catalog_path):
+            write_json_atomic(self.catalog_path, new_products)
+            if self.on_update is not None:
+                self.on_update(new_products)
+        write_json_atomic(self.validators_path, new_validators)
+
+        logger.info("🔄 Синхронизация каталога: %s товаров, изменено %s", len(new_products), changed)
+        return changed
+
+    def start(self, interval):
+        """Запускает синхронизацию по расписанию в фоновом потоке"""
+        self._stop = threading.Event()
+
+        def loop(stop):
+            while True:
+                try:
+                    self.run_once()
+                except Exception:
+                    logger.exception("💥 Ошибка синхронизации каталога")
+                if stop.wait(interval):
+                    return
+
+        threading.Thread(target=loop, args=(self._stop,), name='catalog-sync', daemon=True).start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Синхронизация каталога со страницами товаров')
+    parser.add_argument('--catalog', required=True, help='путь к JSON-файлу каталога')
+    parser.add_argument('--seed', help='JSON со списком товаров, если каталога еще нет')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    seed = []
+    if args.seed:
+        with open(args.seed, encoding='utf-8') as f:
+            seed = json.load(f)
+    CatalogSync(args.catalog, seed, workers=args.workers).run_once()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event
+
+from telegram.ext import Dispatcher, ExtBot, JobQueue, Updater
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedExecutor:
+    """Пул потоков, сохраняющий порядок задач внутри одного ключа.
+
+    Задачи разных чатов выполняются параллельно, а задачи одного чата
+    строго по очереди: пока у чата есть активный обработчик, новые
+    задачи складываются в его очередь.
+    """
+
+    def __init__(self, workers=8, batch_size=16):
+        self.workers = workers
+        self.batch_size = batch_size
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-worker')
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[key] = deque([(fn, args)])
+        self._pool.submit(self._drain, key)
+
+    def pending(self):
+        """Количество задач, ожидающих выполнения"""
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _drain(self, key):
+        processed = 0
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                fn, args = queue.popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("💥 Ошибка при обработке задачи чата %s", key)
+
+            processed += 1
+            if processed >= self.batch_size:
+                # Отдаем поток другим чатам и продолжим эту очередь позже
+                try:
+                    self._pool.submit(self._drain, key)
+                    return
+                except RuntimeError:
+                    # Пул уже останавливается - дорабатываем очередь в этом потоке
+                    processed = 0
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    """Dispatcher, передающий обновления чатов в ChatOrderedExecutor.
+
+    Пока исполнитель не подключен (install), обновления обрабатываются
+    как в обычном Dispatcher. Обновления без чата всегда обрабатываются
+    в потоке диспетчера.
+    """
+
+    __slots__ = ('chat_executor',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_executor = None
+
+    def process_update(self, update):
+        executor = self.chat_executor
+        chat = getattr(update, 'effective_chat', None)
+        if executor is None or chat is None:
+            super().process_update(update)
+        else:
+            executor.submit(chat.id, super().process_update, update)
+
+
+def create_updater(token, base_url=None, persistence=None, workers=4):
+    """Updater с ChatOrderedDispatcher, собранный так же, как его собирает сам Updater"""
+    request = Request(con_pool_size=workers + 4)
+    bot = ExtBot(token, base_url, request=request)
+    job_queue = JobQueue()
+    dispatcher = ChatOrderedDispatcher(
+        bot,
+        Queue(),
+        job_queue=job_queue,
+        workers=workers,
+        exception_event=Event(),
+        persistence=persistence,
+        use_context=True,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    # workers задан в диспетчере; значение Updater по умолчанию (4) с dispatcher не совместимо
+    return Updater(workers=None, dispatcher=dispatcher)
+
+
+def install(dispatcher, workers):
+    """Переключает диспетчер на параллельную обработку чатов с сохранением порядка в чате"""
+    if not isinstance(dispatcher, ChatOrderedDispatcher):
+        raise TypeError("Параллельная обработка чатов требует ChatOrderedDispatcher (chat_executor.create_updater)")
+    executor = ChatOrderedExecutor(workers)
+    dispatcher.chat_executor = executor
+    logger.info("⚙️ Параллельная обработка обновлений: %s потоков", workers)
+    return executor
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен: выключатель разомкнут. retry_after - через сколько секунд пробовать снова"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"Circuit '{name}' is open, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Автоматический выключатель для внешнего сервиса.
+
+    closed - вызовы идут как обычно, подряд идущие ошибки считаются;
+    open - после failure_threshold ошибок вызовы сразу отклоняются;
+    half_open - через reset_timeout (или после удачной проверки probe)
+    пропускается один пробный вызов: успех замыкает цепь, ошибка снова
+    размыкает ее.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, probe=None, probe_interval=5.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.probe_interval = probe_interval
+
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._probe_stop = None
+
+    @property
+    def state(self):
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def _set_state(self, state):
+        if state != self._state:
+            logger.warning("🔌 Выключатель %s: %s -> %s", self.name, self._state, state)
+            self._state = state
+
+    def _maybe_half_open(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+            self._trial_in_flight = False
+
+    def retry_after(self):
+        """0, если вызов сейчас разрешен, иначе примерное время ожидания в секундах"""
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_half_open(now)
+            if self._state == CLOSED:
+                return 0.0
+            if self._state == HALF_OPEN:
+                return 0.0 if not self._trial_in_flight else 1.0
+            return max(0.0, self.reset_timeout - (now - self._opened_at))
+
+    def before_call(self):
+        """Разрешает вызов или бросает CircuitOpenError"""
+        with self._lock:
+            now = time.monotonic()
+            self._maybe_half_open(now)
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            retry_after = max(1.0, self.reset_timeout - (now - self._opened_at))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def _probe_once(self):
+        with self._lock:
+            if self._state != OPEN:
+                return
+        try:
+            healthy = self.probe()
+        except Exception:
+            healthy = False
+        if healthy:
+            with self._lock:
+                if self._state == OPEN:
+                    logger.info("🩺 Проверка %s прошла, пропускаем пробный вызов", self.name)
+                    self._set_state(HALF_OPEN)
+                    self._trial_in_flight = False
+
+    def start_probing(self):
+        """Пока цепь разомкнута, периодически проверяет сервис легким запросом probe"""
+        if self.probe is None:
+            return
+        self._probe_stop = threading.Event()
+
+        def loop(stop):
+            while not stop.wait(self.probe_interval):
+                self._probe_once()
+
+        threading.Thread(target=loop, args=(self._probe_stop,), name=f'{self.name}-probe', daemon=True).start()
+
+    def stop_probing(self):
+        if self._probe_stop is not None:
+            self._probe_stop.set()
+            self._probe_stop = None
+
+
+class AdaptiveTimeout:
+    """Таймаут чтения по наблюдаемым задержкам: перцентиль * multiplier в пределах [minimum, maximum]"""
+
+    def __init__(self, minimum=2.0, maximum=15.0, multiplier=3.0, percentile=99, window=200, min_samples=20):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, duration):
+        with self._lock:
+            self._samples.append(duration)
+
+    def current(self):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.maximum
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return min(self.maximum, max(self.minimum, ordered[index] * self.multiplier))
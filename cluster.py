@@ -0,0 +1,136 @@
+import logging
+import os
+import signal
+import threading
+import time
+import multiprocessing
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+def worker_main(index, workers, update_queue):
+    """Процесс-обработчик: получает обновления своих чатов от мастера и обрабатывает их"""
+    # Ctrl+C обрабатывает мастер, он же присылает сигнал остановки через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import main
+
+    main.setup_logging()
+    # Заявки в CRM отправляет только первый процесс, остальные лишь ставят их в очередь:
+    # он же опрашивает очередь, чтобы увидеть заявки, сохраненные другими процессами.
+    # Сессии читаются из общего хранилища без кеша в памяти, иначе процессы разойдутся.
+    # Защита от дублей тоже общая: неотправленную заявку забывает первый процесс,
+    # а повторный номер проверяет процесс, которому достался чат
+    run_outbox = index == 0
+    main.setup(
+        session_max_size=0,
+        outbox_poll_interval=1.0 if run_outbox else None,
+        dedup_path=main.LEAD_DEDUP_PATH or main.SESSION_DB_PATH
+    )
+
+    updater = main.create_updater(main.BOT_TOKEN, main.TELEGRAM_API_URL)
+    # Общий флуд-лимит делим между процессами, порты метрик разносим.
+    # Каталог с сайта тоже обходит только первый процесс, остальные перечитывают записанный файл
+    stop_services = main.start_services(
+        updater,
+        outbox=run_outbox,
+        catalog_sync=index == 0,
+        send_global_rate=main.SEND_GLOBAL_RATE / workers,
+        metrics_port=main.METRICS_PORT + index if main.METRICS_PORT else 0
+    )
+    dispatcher = updater.dispatcher
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    updater.job_queue.start()
+    logger.info("👷 Процесс %s из %s запущен (pid %s)", index, workers, os.getpid())
+
+    while True:
+        data = update_queue.get()
+        if data is None:
+            break
+        update = Update.de_json(data, updater.bot)
+        if update is not None:
+            dispatcher.update_queue.put(update)
+
+    updater.job_queue.stop()
+    dispatcher.stop()
+    dispatcher_thread.join(timeout=10)
+    stop_services()
+
+
+class Cluster:
+    """Мастер-процесс: опрашивает Telegram и раздает обновления процессам по chat_id.
+
+    Все обновления одного чата попадают в один процесс, поэтому порядок
+    внутри чата сохраняется. Состояние диалогов и ответы опроса лежат в
+    общем хранилище, так что упавший процесс перезапускается без потери
+    сессий, а любой процесс может продолжить любой диалог.
+    """
+
+    def __init__(self, token, workers, base_url=None, poll_timeout=10):
+        self.token = token
+        self.workers = workers
+        self.base_url = base_url
+        self.poll_timeout = poll_timeout
+
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(maxsize=10000) for _ in range(workers)]
+        self._processes = [None] * workers
+        self._stopped = threading.Event()
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=worker_main, args=(index, self.workers, self._queues[index]), name=f'bot-worker-{index}'
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _supervise(self):
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error("💥 Процесс %s завершился с кодом %s, перезапускаем", index, process.exitcode)
+                self._spawn(index)
+
+    def shard(self, update):
+        """Номер процесса для обновления"""
+        chat = update.effective_chat
+        return chat.id % self.workers if chat is not None else 0
+
+    def stop(self, signum=None, frame=None):
+        self._stopped.set()
+
+    def run(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+        bot = Bot(self.token, base_url=self.base_url) if self.base_url else Bot(self.token)
+        bot.delete_webhook()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.stop)
+        logger.info("✅ Мастер запущен, процессов: %s", self.workers)
+
+        offset = None
+        while not self._stopped.is_set():
+            self._supervise()
+            try:
+                updates = bot.get_updates(offset=offset, timeout=self.poll_timeout)
+            except TelegramError as e:
+                logger.warning("⚠️ Ошибка получения обновлений: %s", e)
+                time.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                self._queues[self.shard(update)].put(update.to_dict())
+
+        logger.info("🛑 Остановка процессов...")
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout=15)
+            if process.is_alive():
+                process.terminate()
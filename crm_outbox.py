@@ -0,0 +1,250 @@
+import argparse
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CrmOutbox:
+    """Надежная очередь заявок в CRM на SQLite.
+
+    Заявка сначала сохраняется на диск, а отправляется фоновыми потоками
+    с повторными попытками и экспоненциальной задержкой. Неотправленные
+    заявки переживают перезапуск бота. Заявки, исчерпавшие max_attempts,
+    получают статус failed (on_failed сообщает о них) и возвращаются в
+    очередь через requeue_failed.
+    """
+
+    def __init__(self, path, sender, workers=2, max_attempts=8, base_delay=5.0, max_delay=600.0,
+                 poll_interval=None, on_failed=None, db_retry_delay=1.0):
+        self.path = path
+        self.sender = sender
+        # Вызывается как on_failed(phone_number, user_id), когда заявка окончательно не отправлена
+        self.on_failed = on_failed
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Если заявки добавляют другие процессы, уведомления до нас не дойдут - опрашиваем базу
+        self.poll_interval = poll_interval
+        # Пауза перед повтором, если база временно недоступна (например, заблокирована другим процессом)
+        self.db_retry_delay = db_retry_delay
+
+        self._conn = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._threads = []
+
+    def _connect(self):
+        """Открывает базу при первом обращении (вызывается под блокировкой)"""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS leads ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' phone TEXT NOT NULL,'
+                ' user_name TEXT,'
+                ' created_at REAL NOT NULL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' next_attempt_at REAL NOT NULL,'
+                " status TEXT NOT NULL DEFAULT 'pending',"
+                ' last_error TEXT,'
+                ' user_id INTEGER)'
+            )
+            # Базы, созданные до появления user_id
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(leads)')]
+            if 'user_id' not in columns:
+                self._conn.execute('ALTER TABLE leads ADD COLUMN user_id INTEGER')
+        return self._conn
+
+    def enqueue(self, phone_number, user_name=None, user_id=None):
+        """Сохраняет заявку в очередь и возвращает ее id"""
+        with self._lock:
+            cursor = self._connect().execute(
+                'INSERT INTO leads (phone, user_name, user_id, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)',
+                (phone_number, user_name, user_id, time.time(), 0)
+            )
+            self._wakeup.notify()
+            return cursor.lastrowid
+
+    def pending_count(self):
+        """Количество заявок, ожидающих отправки"""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT COUNT(*) FROM leads WHERE status IN ('pending', 'sending')"
+            ).fetchone()
+            return row[0]
+
+    def failed_count(self):
+        """Количество заявок, которые не удалось отправить за max_attempts попыток"""
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM leads WHERE status = 'failed'").fetchone()[0]
+
+    def requeue_failed(self):
+        """Возвращает неотправленные заявки в очередь с нулевым счетчиком попыток"""
+        with self._lock:
+            requeued = self._connect().execute(
+                "UPDATE leads SET status = 'pending', attempts = 0, next_attempt_at = 0 WHERE status = 'failed'"
+            ).rowcount
+            self._wakeup.notify_all()
+        if requeued:
+            logger.info("🔁 Возвращено в очередь заявок: %s", requeued)
+        return requeued
+
+    def start(self):
+        """Запускает фоновые потоки отправки"""
+        with self._lock:
+            # Заявки, которые отправлялись в момент падения, возвращаем в очередь.
+            # Делает это только процесс-отправитель: остальные процессы лишь добавляют заявки
+            self._connect().execute("UPDATE leads SET status = 'pending' WHERE status = 'sending'")
+            self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'crm-outbox-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("📮 Очередь заявок CRM запущена (%s потоков, в очереди: %s)", self.workers, self.pending_count())
+
+    def stop(self, timeout=None):
+        """Останавливает потоки; неотправленные заявки остаются в базе"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _claim(self):
+        """Забирает ближайшую заявку, готовую к отправке, или возвращает задержку до следующей"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT id, phone, user_name, user_id, attempts, next_attempt_at FROM leads"
+            " WHERE status = 'pending' ORDER BY next_attempt_at, id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None, None
+
+        delay = row[5] - time.time()
+        if delay > 0:
+            return None, delay
+
+        # Условие по статусу не дает двум процессам забрать одну заявку
+        claimed = conn.execute(
+            "UPDATE leads SET status = 'sending' WHERE id = ? AND status = 'pending'", (row[0],)
+        ).rowcount
+        if not claimed:
+            return None, 0
+        return row, None
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _finish(self, lead_id, attempts, success, error=None):
+        failed = False
+        with self._lock:
+            conn = self._connect()
+            if success:
+                conn.execute('DELETE FROM leads WHERE id = ?', (lead_id,))
+            elif attempts >= self.max_attempts:
+                conn.execute(
+                    "UPDATE leads SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, error, lead_id)
+                )
+                logger.error("❌ Заявка #%s не отправлена после %s попыток", lead_id, attempts)
+                failed = True
+            else:
+                conn.execute(
+                    "UPDATE leads SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ?"
+                    " WHERE id = ?",
+                    (attempts, time.time() + self._backoff(attempts), error, lead_id)
+                )
+                self._wakeup.notify()
+        return failed
+
+    def _defer(self, lead_id, delay):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE leads SET status = 'pending', next_attempt_at = ? WHERE id = ?",
+                (time.time() + delay, lead_id)
+            )
+
+    def _next_lead(self):
+        """Ждет и забирает следующую заявку; None - поток пора остановить"""
+        with self._lock:
+            while True:
+                if self._stopping:
+                    return None
+                try:
+                    row, delay = self._claim()
+                except sqlite3.Error:
+                    # Например, "database is locked", пока пишут другие процессы - повторим позже
+                    logger.exception("💥 Ошибка чтения очереди заявок")
+                    row, delay = None, self.db_retry_delay
+                if row is not None:
+                    return row
+                if self.poll_interval is not None:
+                    delay = self.poll_interval if delay is None else min(delay, self.poll_interval)
+                self._wakeup.wait(delay)
+
+    def _store_result(self, step, *args):
+        """Записывает итог отправки, повторяя при ошибках базы, чтобы заявка не застряла в sending"""
+        while True:
+            try:
+                return step(*args)
+            except sqlite3.Error:
+                logger.exception("💥 Ошибка записи результата заявки #%s", args[0])
+            with self._lock:
+                if self._stopping:
+                    # Заявка останется в sending и вернется в очередь при следующем start()
+                    return False
+                self._wakeup.wait(self.db_retry_delay)
+
+    def _worker_loop(self):
+        while True:
+            row = self._next_lead()
+            if row is None:
+                return
+
+            lead_id, phone_number, user_name, user_id, attempts, _ = row
+            error = None
+            try:
+                success = self.sender(phone_number, user_name)
+            except Exception as e:
+                # Отправитель просит подождать (например, CRM недоступна) - попытку не засчитываем
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is not None:
+                    self._store_result(self._defer, lead_id, retry_after)
+                    continue
+                success = False
+                error = str(e)
+
+            if not success and error is None:
+                error = 'CRM rejected the lead'
+            failed = self._store_result(self._finish, lead_id, attempts + 1, success, error)
+            if failed and self.on_failed is not None:
+                try:
+                    self.on_failed(phone_number, user_id)
+                except Exception:
+                    logger.exception("💥 Ошибка обработчика неотправленной заявки #%s", lead_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обслуживание очереди заявок CRM')
+    parser.add_argument('path', help='файл очереди (CRM_OUTBOX_PATH)')
+    parser.add_argument('--requeue', action='store_true', help='вернуть неотправленные заявки в очередь')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    outbox = CrmOutbox(args.path, sender=None)
+    if args.requeue:
+        outbox.requeue_failed()
+    print(f"В очереди: {outbox.pending_count()}, не отправлено: {outbox.failed_count()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import os
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Общий HTTP-транспорт к сайту ya7auto.ru: пул соединений с keep-alive,
+# чтобы каждая заявка не платила за новое TCP/TLS рукопожатие
+CRM_BASE_URL = os.getenv('CRM_BASE_URL', 'https://ya7auto.ru')
+CONNECT_TIMEOUT = float(os.getenv('CRM_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.getenv('CRM_READ_TIMEOUT', '15'))
+POOL_SIZE = int(os.getenv('CRM_POOL_SIZE', '10'))
+
+# Заголовки как у браузера
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
+    'Connection': 'keep-alive',
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Возвращает общую сессию с пулом соединений"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.headers.update(DEFAULT_HEADERS)
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE, pool_block=False)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def request(method, url, **kwargs):
+    """Выполняет запрос через общий пул с раздельными таймаутами соединения и чтения"""
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def warm_up(url=None):
+    """Заранее открывает TLS-соединение к CRM, чтобы первая заявка не ждала рукопожатия"""
+    url = url or CRM_BASE_URL
+    started = time.monotonic()
+    try:
+        request('HEAD', url, allow_redirects=False)
+    except requests.RequestException as e:
+        logger.warning("⚠️ Не удалось прогреть соединение с %s: %s", url, e)
+        return False
+    logger.info("🔥 Соединение с %s прогрето за %.0f мс", url, (time.monotonic() - started) * 1000)
+    return True
+
+
+def close():
+    """Закрывает все соединения пула"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,323 @@
+"""Локальные заглушки Telegram Bot API, CRM и сайта для нагрузочных тестов и test_bot.py"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def reply(self, status, body=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+class _BackgroundServer:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self._httpd = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), self.make_handler())
+        self._httpd.daemon_threads = True
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def make_handler(self):
+        raise NotImplementedError
+
+
+class FakeTelegramServer(_BackgroundServer):
+    """Заглушка Bot API: отдает обновления через getUpdates и запоминает ответы бота.
+
+    Бот подключается к ней через base_url=f"{server.url}/bot".
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._lock = threading.Condition()
+        self._listeners = {}
+        self.sent = []
+        self.api_calls = 0
+
+    def push_message(self, chat_id, text=None, contact=None, first_name='User'):
+        """Кладет в очередь обновление с сообщением пользователя; возвращает update_id"""
+        user = {'id': chat_id, 'is_bot': False, 'first_name': first_name}
+        with self._lock:
+            message = {
+                'message_id': self._next_message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private', 'first_name': first_name},
+                'from': user,
+            }
+            self._next_message_id += 1
+            if text is not None:
+                message['text'] = text
+                if text.startswith('/'):
+                    message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            if contact is not None:
+                message['contact'] = {'phone_number': contact, 'first_name': first_name, 'user_id': chat_id}
+
+            update = {'update_id': self._next_update_id, 'message': message}
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._lock.notify_all()
+            return update['update_id']
+
+    def listen(self, chat_id, callback):
+        """Подписывает callback(method, payload) на ответы бота в чат"""
+        with self._lock:
+            self._listeners[chat_id] = callback
+
+    def unlisten(self, chat_id):
+        with self._lock:
+            self._listeners.pop(chat_id, None)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            # Подтвержденные обновления больше не нужны
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            return list(self._updates)
+
+    def _bot_message(self, method, params):
+        with self._lock:
+            message_id = params.get('message_id') or self._next_message_id
+            if 'message_id' not in params:
+                self._next_message_id += 1
+            chat_id = int(params['chat_id'])
+            self.sent.append((method, chat_id, params))
+            listener = self._listeners.get(chat_id)
+        if listener is not None:
+            listener(method, params)
+        return {
+            'message_id': int(message_id),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    def call(self, method, params):
+        self.api_calls += 1
+        if method == 'getMe':
+            return self.BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method in ('sendMessage', 'editMessageText'):
+            return self._bot_message(method, params)
+        if method in ('deleteWebhook', 'setWebhook', 'answerCallbackQuery', 'sendChatAction'):
+            return True
+        raise KeyError(method)
+
+    def make_handler(self):
+        server = self
+
+        class Handler(_QuietHandler):
+            def do_POST(self):
+                body = self.read_body()
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                content_type = self.headers.get('Content-Type', '')
+                if 'json' in content_type:
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+                try:
+                    result = {'ok': True, 'result': server.call(method, params)}
+                    status = 200
+                except KeyError:
+                    result = {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+                    status = 404
+                self.reply(status, json.dumps(result).encode())
+
+            do_GET = do_POST
+
+        return Handler
+
+
+class FakeCrmServer(_BackgroundServer):
+    """Заглушка веб-формы CRM с настраиваемой задержкой и долей ошибок"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.leads = []
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def make_handler(self):
+        server = self
+
+        class Handler(_QuietHandler):
+            def do_HEAD(self):
+                self.reply(200, content_type='text/html')
+
+            def do_GET(self):
+                self.reply(200, b'<html><form method="post"><input name="phone"></form></html>', 'text/html')
+
+            def do_POST(self):
+                body = self.read_body()
+                delay = server.latency + random.uniform(0, server.jitter)
+                if delay:
+                    time.sleep(delay)
+
+                with server._lock:
+                    server.requests += 1
+                    failed = random.random() < server.error_rate
+                    if not failed:
+                        fields = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                        server.leads.append((time.monotonic(), fields))
+
+                if failed:
+                    self.reply(500, b'error', 'text/plain')
+                else:
+                    self.reply(200, 'Спасибо!'.encode(), 'text/html; charset=utf-8')
+
+        return Handler
+
+
+class FakeShopServer(_BackgroundServer):
+    """Заглушка страниц товаров сайта с ETag: повторный условный GET получает 304"""
+
+    def __init__(self, pages=None, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        # Путь -> HTML; страницу можно подменить на ходу, ETag изменится вместе с ней
+        self.pages = dict(pages or {})
+        self.requests = []
+
+    def link(self, path):
+        return self.url + path
+
+    def make_handler(self):
+        server = self
+
+        class Handler(_QuietHandler):
+            def do_GET(self):
+                page = server.pages.get(self.path)
+                if page is None:
+                    server.requests.append((self.path, 404))
+                    self.reply(404, content_type='text/html')
+                    return
+
+                body = page.encode('utf-8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    server.requests.append((self.path, 304))
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                server.requests.append((self.path, 200))
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+class FakeFormServer(_BackgroundServer):
+    """Заглушка страницы с формой заявки: ETag, CSRF-токен и управляемые ответы.
+
+    Форма отдается с ETag (повторный условный GET получает 304), POST со
+    старым токеном отклоняется статусом reject_status, а page_status
+    позволяет вернуть вместо формы страницу ошибки.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.token = 'token-1'
+        self.page_status = 200
+        self.reject_status = 403
+        self.gets = []
+        self.leads = []
+
+    def page(self):
+        return (
+            '<html><body><form action="/lead" method="post">'
+            f'<input type="hidden" name="_token" value="{self.token}">'
+            '<input type="tel" name="phone" required>'
+            '</form></body></html>'
+        )
+
+    def make_handler(self):
+        server = self
+
+        class Handler(_QuietHandler):
+            def do_GET(self):
+                if server.page_status != 200:
+                    server.gets.append(server.page_status)
+                    self.reply(server.page_status, b'error', 'text/html')
+                    return
+                body = server.page().encode('utf-8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    server.gets.append(304)
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                server.gets.append(200)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                fields = {key: values[0] for key, values in parse_qs(self.read_body().decode()).items()}
+                if fields.get('_token') != server.token:
+                    self.reply(server.reject_status, b'token mismatch', 'text/plain')
+                    return
+                server.leads.append(fields)
+                self.reply(200, 'Спасибо!'.encode(), 'text/html; charset=utf-8')
+
+        return Handler
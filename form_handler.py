@@ -1,63 +1,199 @@
-import requests
-from bs4 import BeautifulSoup
+import crm_transport
 from urllib.parse import urljoin, urlparse
-import re
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Время жизни закешированной схемы формы (секунды)
+FORM_SCHEMA_TTL = float(os.getenv('FORM_SCHEMA_TTL', '600'))
+
+# Статусы, при которых сервер отверг устаревший токен формы
+STALE_TOKEN_STATUSES = (403, 419)
+
+
+def default_parser():
+    """Выбирает парсер: из FORM_PARSER, иначе lxml при наличии, иначе html.parser"""
+    parser = os.getenv('FORM_PARSER')
+    if parser:
+        return parser
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
 
 
 class SimpleFormHandler:
-    def __init__(self, form_url):
+    def __init__(self, form_url, schema_ttl=FORM_SCHEMA_TTL, parser=None):
         self.form_url = form_url
         self.base_url = self.get_base_url(form_url)
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-        })
+        self.schema_ttl = schema_ttl
+        self.parser = parser or default_parser()
+
+        # Кеш разобранной формы и валидаторы для условного GET
+        self._schema = None
+        self._schema_fetched_at = 0.0
+        self._etag = None
+        self._last_modified = None
+        self._schema_lock = threading.Lock()
+        self._prefetch_stop = None
 
     def get_base_url(self, url):
         parsed = urlparse(url)
         return f"{parsed.scheme}://{parsed.netloc}"
 
+    def get_form_schema(self, force=False):
+        """Возвращает схему формы из кеша, при необходимости перепроверяя ее на сервере"""
+        with self._schema_lock:
+            fresh = time.monotonic() - self._schema_fetched_at < self.schema_ttl
+            if self._schema is not None and fresh and not force:
+                return self._schema
+
+            headers = {}
+            if self._schema is not None and not force:
+                if self._etag:
+                    headers['If-None-Match'] = self._etag
+                if self._last_modified:
+                    headers['If-Modified-Since'] = self._last_modified
+
+            response = crm_transport.get(self.form_url, headers=headers)
+
+            # Форма не изменилась - продлеваем кеш без повторного разбора
+            if response.status_code == 304 and self._schema is not None:
+                self._schema_fetched_at = time.monotonic()
+                return self._schema
+
+            # Страница ошибки не должна вытеснить рабочую схему: оставляем прежнюю до следующей попытки
+            if response.status_code != 200:
+                logger.warning("⚠️ Страница формы вернула %s, оставляем закешированную схему", response.status_code)
+                return self._schema
+
+            self._schema = self.parse_form(response.text)
+            self._schema_fetched_at = time.monotonic()
+            self._etag = response.headers.get('ETag')
+            self._last_modified = response.headers.get('Last-Modified')
+            return self._schema
+
+    def invalidate_schema(self):
+        """Сбрасывает кеш схемы формы"""
+        with self._schema_lock:
+            self._schema = None
+            self._schema_fetched_at = 0.0
+            self._etag = None
+            self._last_modified = None
+
+    def prefetch(self):
+        """Заранее загружает форму и ее скрытые токены, чтобы заявка ушла одним POST"""
+        try:
+            return self.get_form_schema() is not None
+        except Exception as e:
+            logger.warning("⚠️ Не удалось заранее загрузить форму: %s", e)
+            return False
+
+    def start_prefetch(self, interval=None):
+        """Запускает фоновое обновление схемы до истечения TTL"""
+        interval = interval or max(self.schema_ttl * 0.8, 1)
+        self._prefetch_stop = threading.Event()
+
+        def loop(stop):
+            while not stop.is_set():
+                self.prefetch()
+                stop.wait(interval)
+
+        threading.Thread(target=loop, args=(self._prefetch_stop,), name='form-prefetch', daemon=True).start()
+
+    def stop_prefetch(self):
+        if self._prefetch_stop is not None:
+            self._prefetch_stop.set()
+            self._prefetch_stop = None
+
+    def parse_form(self, html):
+        """Разбирает страницу и извлекает из первой формы все, что нужно для отправки"""
+        # bs4 заметно увеличивает время запуска и память, поэтому загружаем его только здесь
+        from bs4 import BeautifulSoup, SoupStrainer
+
+        soup = BeautifulSoup(html, self.parser, parse_only=SoupStrainer('form'))
+
+        form = soup.find('form')
+        if not form:
+            return None
+
+        # Получаем action формы
+        form_action = form.get('action', '')
+        if form_action.startswith('/'):
+            form_action = urljoin(self.base_url, form_action)
+        elif not form_action.startswith(('http://', 'https://')):
+            form_action = self.form_url
+
+        fields = form.find_all(['input', 'textarea', 'select'])
+
+        # Находим обязательные поля
+        required_fields = []
+        for input_tag in fields:
+            if input_tag.get('required') and input_tag.get('name'):
+                required_fields.append({
+                    'name': input_tag.get('name'),
+                    'type': input_tag.get('type', 'text'),
+                    'label': self.get_field_label(input_tag)
+                })
+
+        # Собираем все скрытые поля (в том числе CSRF-токены)
+        hidden_fields = {}
+        for input_tag in form.find_all('input', type='hidden'):
+            name = input_tag.get('name')
+            if name:
+                hidden_fields[name] = input_tag.get('value', '')
+
+        return {
+            'action': form_action,
+            'method': form.get('method', 'post').lower(),
+            'required_fields': required_fields,
+            'all_fields': [tag.get('name') for tag in fields if tag.get('name')],
+            'hidden_fields': hidden_fields,
+            'phone_field': self.find_phone_field(form),
+        }
+
+    def find_phone_field(self, form):
+        """Определяет имя поля для телефона"""
+        text_fields = form.find_all(['input', 'textarea'])
+
+        for input_tag in text_fields:
+            name = input_tag.get('name')
+            if name and any(phone_word in name.lower() for phone_word in ['phone', 'tel', 'telephone', 'mobile']):
+                return name
+
+        # Если не нашли по имени, ищем по типу
+        for input_tag in form.find_all('input', type='tel'):
+            name = input_tag.get('name')
+            if name:
+                return name
+
+        # Если все еще не нашли, используем первое текстовое поле
+        for input_tag in text_fields:
+            if input_tag.get('type') in ['text', None] and input_tag.get('name'):
+                return input_tag.get('name')
+
+        return None
+
     def analyze_form(self):
         """Анализирует форму и возвращает необходимые поля"""
         try:
-            response = self.session.get(self.form_url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            form = soup.find('form')
-            if not form:
+            schema = self.get_form_schema()
+            if not schema:
                 return None
 
-            # Получаем action формы
-            form_action = form.get('action', '')
-            if form_action.startswith('/'):
-                form_action = urljoin(self.base_url, form_action)
-            elif not form_action.startswith(('http://', 'https://')):
-                form_action = self.form_url
-
-            # Находим обязательные поля
-            required_fields = []
-            for input_tag in form.find_all(['input', 'textarea', 'select']):
-                if input_tag.get('required') and input_tag.get('name'):
-                    field_name = input_tag.get('name')
-                    field_type = input_tag.get('type', 'text')
-                    required_fields.append({
-                        'name': field_name,
-                        'type': field_type,
-                        'label': self.get_field_label(input_tag)
-                    })
-
             return {
-                'action': form_action,
-                'method': form.get('method', 'post').lower(),
-                'required_fields': required_fields,
-                'all_fields': [tag.get('name') for tag in form.find_all(['input', 'textarea', 'select']) if
-                               tag.get('name')]
+                'action': schema['action'],
+                'method': schema['method'],
+                'required_fields': schema['required_fields'],
+                'all_fields': schema['all_fields']
             }
 
         except Exception as e:
-            print(f"Error analyzing form: {e}")
+            logger.error("💥 Ошибка анализа формы: %s", e)
             return None
 
     def get_field_label(self, input_tag):
@@ -81,65 +217,18 @@ class SimpleFormHandler:
     def submit_phone_only(self, phone_number):
         """Отправляет форму только с телефоном"""
         try:
-            response = self.session.get(self.form_url)
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            form = soup.find('form')
-            if not form:
+            schema = self.get_form_schema()
+            if not schema:
                 return False, "Form not found"
 
-            # Получаем action
-            form_action = form.get('action', '')
-            if form_action.startswith('/'):
-                form_action = urljoin(self.base_url, form_action)
-            elif not form_action.startswith(('http://', 'https://')):
-                form_action = self.form_url
-
-            # Собираем все скрытые поля
-            form_data = {}
-            for input_tag in form.find_all('input', type='hidden'):
-                name = input_tag.get('name')
-                value = input_tag.get('value', '')
-                if name:
-                    form_data[name] = value
-
-            # Находим поле для телефона
-            phone_field = None
-            for input_tag in form.find_all(['input', 'textarea']):
-                name = input_tag.get('name')
-                if name and any(phone_word in name.lower() for phone_word in ['phone', 'tel', 'telephone', 'mobile']):
-                    phone_field = name
-                    break
-
-            # Если не нашли по имени, ищем по типу
-            if not phone_field:
-                for input_tag in form.find_all('input', type='tel'):
-                    name = input_tag.get('name')
-                    if name:
-                        phone_field = name
-                        break
-
-            # Если все еще не нашли, используем первое текстовое поле
-            if not phone_field:
-                for input_tag in form.find_all(['input', 'textarea']):
-                    if input_tag.get('type') in ['text', None] and input_tag.get('name'):
-                        phone_field = input_tag.get('name')
-                        break
-
-            if phone_field:
-                form_data[phone_field] = phone_number
-
-            # Отправляем форму
-            method = form.get('method', 'post').lower()
-            if method == 'post':
-                response = self.session.post(form_action, data=form_data, headers={
-                    'Referer': self.form_url,
-                    'Origin': self.base_url
-                })
-            else:
-                response = self.session.get(form_action, params=form_data, headers={
-                    'Referer': self.form_url
-                })
+            response = self._send_form(schema, phone_number)
+
+            # Токен формы устарел - обновляем схему и пробуем еще раз
+            if response.status_code in STALE_TOKEN_STATUSES:
+                schema = self.get_form_schema(force=True)
+                if not schema:
+                    return False, "Form not found"
+                response = self._send_form(schema, phone_number)
 
             # Проверяем успешность
             if response.status_code == 200:
@@ -151,4 +240,19 @@ class SimpleFormHandler:
                 return False, f"Server returned status: {response.status_code}"
 
         except Exception as e:
-            return False, f"Error: {str(e)}"
\ No newline at end of file
+            return False, f"Error: {str(e)}"
+
+    def _send_form(self, schema, phone_number):
+        form_data = dict(schema['hidden_fields'])
+        if schema['phone_field']:
+            form_data[schema['phone_field']] = phone_number
+
+        # Отправляем форму
+        if schema['method'] == 'post':
+            return crm_transport.post(schema['action'], data=form_data, headers={
+                'Referer': self.form_url,
+                'Origin': self.base_url
+            })
+        return crm_transport.get(schema['action'], params=form_data, headers={
+            'Referer': self.form_url
+        })
@@ -0,0 +1,99 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class LeadDeduplicator:
+    """Кеш идемпотентности заявок: (user_id, телефон) -> время последней заявки.
+
+    Повторная заявка с тем же номером от того же пользователя в пределах
+    window секунд считается дублем и не уходит в CRM. Записи вытесняются
+    по LRU (не больше max_size) и по истечении окна; при заданном path
+    кеш сохраняется в SQLite и переживает перезапуск. С path решение о
+    дубле принимает база, а не память процесса: в кластере заявку
+    забывает процесс с очередью CRM, а проверяет процесс, ведущий чат.
+    """
+
+    def __init__(self, window=86400.0, max_size=50000, path=None):
+        self.window = window
+        self.max_size = max_size
+        self.path = path
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if path:
+            self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS leads_seen ('
+                ' user_id INTEGER NOT NULL,'
+                ' phone TEXT NOT NULL,'
+                ' submitted_at REAL NOT NULL,'
+                ' PRIMARY KEY (user_id, phone))'
+            )
+            self._load()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _load(self):
+        cutoff = time.time() - self.window
+        self._conn.execute('DELETE FROM leads_seen WHERE submitted_at < ?', (cutoff,))
+        rows = self._conn.execute(
+            'SELECT user_id, phone, submitted_at FROM leads_seen ORDER BY submitted_at DESC LIMIT ?',
+            (self.max_size,)
+        ).fetchall()
+        for user_id, phone, submitted_at in reversed(rows):
+            self._seen[(user_id, phone)] = submitted_at
+        logger.info("🧾 Загружено %s недавних заявок для защиты от дублей", len(rows))
+
+    def check_and_remember(self, user_id, phone):
+        """Возвращает True, если заявка новая (и запоминает ее), False - если это дубль"""
+        key = (user_id, phone)
+        now = time.time()
+        with self._lock:
+            if self._conn is not None:
+                # Одним запросом: запись добавляется или обновляется, только если ее нет или окно истекло
+                is_new = self._conn.execute(
+                    'INSERT INTO leads_seen (user_id, phone, submitted_at) VALUES (?, ?, ?)'
+                    ' ON CONFLICT (user_id, phone) DO UPDATE SET submitted_at = excluded.submitted_at'
+                    ' WHERE leads_seen.submitted_at < ?',
+                    (user_id, phone, now, now - self.window)
+                ).rowcount > 0
+            else:
+                submitted_at = self._seen.get(key)
+                is_new = submitted_at is None or now - submitted_at >= self.window
+
+            if not is_new:
+                if key in self._seen:
+                    self._seen.move_to_end(key)
+                return False
+
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def forget(self, user_id, phone):
+        """Убирает заявку из кеша (например, если ее не удалось сохранить)"""
+        with self._lock:
+            self._seen.pop((user_id, phone), None)
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM leads_seen WHERE user_id = ? AND phone = ?', (user_id, phone))
+
+    def purge_expired(self):
+        """Удаляет записи старше окна и возвращает их количество"""
+        cutoff = time.time() - self.window
+        with self._lock:
+            expired = [key for key, submitted_at in self._seen.items() if submitted_at < cutoff]
+            for key in expired:
+                del self._seen[key]
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM leads_seen WHERE submitted_at < ?', (cutoff,))
+        return len(expired)
@@ -0,0 +1,203 @@
+"""Офлайн нагрузочный тест бота.
+
+Поднимает локальные заглушки Telegram Bot API и CRM, запускает настоящие
+обработчики бота и проводит N пользователей через весь опрос
+/start -> автозапуск -> управление -> GPS -> телефон.
+
+Пример:
+    python loadtest.py --users 200 --concurrency 50 --crm-latency 2 --crm-error-rate 0.2
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_servers import FakeCrmServer, FakeTelegramServer
+
+FAKE_TOKEN = '123456:LOADTEST'
+
+# Шаги опроса: (состояние, текст пользователя)
+SCENARIO = [
+    ('start', '/start'),
+    ('autostart', 'С автозапуском'),
+    ('control', '😎 Приложение в телефоне'),
+    ('gps', 'Да, нужен GPS'),
+    ('phone', None),
+]
+
+
+def percentile(values, pct):
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+class SimulatedUser:
+    """Пользователь, проходящий опрос и ждущий ответа бота на каждом шаге"""
+
+    def __init__(self, telegram, chat_id, step_timeout):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.step_timeout = step_timeout
+        self.phone = f"+79{chat_id % 10 ** 9:09d}"
+        self.latencies = {}
+        self.phone_sent_at = None
+        self._replied = threading.Event()
+
+    def _on_reply(self, method, params):
+        # Шаг завершен, когда бот прислал сообщение с клавиатурой
+        if params.get('reply_markup'):
+            self._replied.set()
+
+    def run(self):
+        self.telegram.listen(self.chat_id, self._on_reply)
+        try:
+            for state, text in SCENARIO:
+                self._replied.clear()
+                started = time.monotonic()
+                if state == 'phone':
+                    self.phone_sent_at = started
+                    self.telegram.push_message(self.chat_id, text=self.phone)
+                else:
+                    self.telegram.push_message(self.chat_id, text=text)
+
+                if not self._replied.wait(self.step_timeout):
+                    raise TimeoutError(f"chat {self.chat_id}: нет ответа на шаге {state}")
+                self.latencies[state] = time.monotonic() - started
+        finally:
+            self.telegram.unlisten(self.chat_id)
+
+
+def start_bot(telegram, crm):
+    """Запускает настоящий бот против заглушек; возвращает функцию остановки"""
+    workdir = tempfile.mkdtemp(prefix='alarmbot-loadtest-')
+    os.environ.update({
+        'BOT_TOKEN': FAKE_TOKEN,
+        'TELEGRAM_API_URL': f"{telegram.url}/bot",
+        'CRM_FORM_URL': f"{crm.url}/crm/form/iframe/3/",
+        'CRM_BASE_URL': crm.url,
+        'CRM_OUTBOX_PATH': os.path.join(workdir, 'outbox.db'),
+    })
+    os.environ.setdefault('CRM_OUTBOX_WORKERS', '4')
+
+    # Импортируем после настройки окружения: main читает его при загрузке
+    import main
+
+    main.setup_logging()
+    main.setup()
+    main.crm_outbox.base_delay = 0.2
+    updater = main.create_updater(FAKE_TOKEN, main.TELEGRAM_API_URL)
+    stop_services = main.start_services(updater)
+    updater.start_polling(poll_interval=0.0, timeout=1)
+
+    def stop():
+        updater.stop()
+        stop_services()
+
+    return stop
+
+
+def run(users, concurrency, crm_latency, crm_jitter, crm_error_rate, step_timeout, drain_timeout):
+    telegram = FakeTelegramServer().start()
+    crm = FakeCrmServer(latency=crm_latency, jitter=crm_jitter, error_rate=crm_error_rate).start()
+    stop_bot = start_bot(telegram, crm)
+
+    simulated = [SimulatedUser(telegram, 100000 + i, step_timeout) for i in range(users)]
+    errors = []
+
+    def drive(user):
+        try:
+            user.run()
+        except Exception as e:
+            errors.append(str(e))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(drive, simulated))
+    elapsed = time.monotonic() - started
+
+    # Ждем, пока очередь заявок доставит все лиды в CRM
+    completed = [user for user in simulated if 'phone' in user.latencies]
+    deadline = time.monotonic() + drain_timeout
+    while len(crm.leads) < len(completed) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    delivered_at = {fields.get('phone'): at for at, fields in crm.leads}
+    delivery = [delivered_at[user.phone] - user.phone_sent_at for user in completed if user.phone in delivered_at]
+
+    stop_bot()
+    telegram.stop()
+    crm.stop()
+
+    return {
+        'users': users,
+        'concurrency': concurrency,
+        'completed': len(completed),
+        'errors': len(errors),
+        'elapsed_s': round(elapsed, 3),
+        'conversations_per_s': round(len(completed) / elapsed, 2) if elapsed else 0.0,
+        'states': {
+            state: summarize([user.latencies[state] for user in simulated if state in user.latencies])
+            for state, _ in SCENARIO
+        },
+        'crm': {
+            'requests': crm.requests,
+            'leads_delivered': len(delivery),
+            'delivery': summarize(delivery),
+        },
+        'bot_api_calls': telegram.api_calls,
+        'error_samples': errors[:5],
+    }
+
+
+def print_report(report):
+    print(f"Пользователей: {report['users']} (параллельно {report['concurrency']}), "
+          f"завершили: {report['completed']}, ошибок: {report['errors']}")
+    print(f"Время: {report['elapsed_s']} с, пропускная способность: {report['conversations_per_s']} диалогов/с")
+    print(f"{'состояние':<12}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for state, stats in report['states'].items():
+        print(f"{state:<12}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+    crm = report['crm']
+    delivery = crm['delivery']
+    print(f"CRM: запросов {crm['requests']}, доставлено лидов {crm['leads_delivered']}, "
+          f"доставка p50/p95/p99: {delivery['p50_ms']}/{delivery['p95_ms']}/{delivery['p99_ms']} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн нагрузочный тест бота')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--crm-latency', type=float, default=0.1, help='задержка ответа CRM, с')
+    parser.add_argument('--crm-jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--crm-error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--step-timeout', type=float, default=30.0)
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--json', dest='json_path', help='сохранить отчет в JSON')
+    args = parser.parse_args()
+
+    report = run(args.users, args.concurrency, args.crm_latency, args.crm_jitter, args.crm_error_rate,
+                 args.step_timeout, args.drain_timeout)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
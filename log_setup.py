@@ -0,0 +1,180 @@
+import atexit
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Библиотеки, чьи INFO-записи бесполезны и многочисленны: APScheduler пишет по две строки
+# на каждое обновление (задача таймаута диалога добавляется и удаляется)
+QUIET_LOGGERS = ('apscheduler',)
+
+# Поля контекста, которые попадают в каждую запись
+CONTEXT_FIELDS = ('update_id', 'chat_id', 'state', 'duration_ms', 'event')
+
+# Последовательности, похожие на номер телефона: +7 (999) 123-45-67, 89991234567, 999 123-45-67.
+# Голые 10-значные числа (id пользователей Telegram) номером не считаются
+PHONE_RE = re.compile(
+    r'\+\d[\d\s\-()]{8,}\d'
+    r'|(?<![\d+])[78][\s\-(]*\d{3}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}(?!\d)'
+    r'|(?<![\d+])\(?\d{3}\)?[\s\-]\d{3}[\s\-]\d{2}[\s\-]?\d{2}(?!\d)'
+)
+
+_context = threading.local()
+_listener = None
+
+
+def redact_phones(text):
+    """Маскирует номера телефонов, оставляя две последние цифры"""
+    def mask(match):
+        value = match.group(0)
+        digits = sum(ch.isdigit() for ch in value)
+        if digits < 10:
+            return value
+        seen = 0
+        result = []
+        for ch in value:
+            if ch.isdigit():
+                seen += 1
+                result.append(ch if seen > digits - 2 else '*')
+            else:
+                result.append(ch)
+        return ''.join(result)
+
+    return PHONE_RE.sub(mask, text)
+
+
+def get_context():
+    return getattr(_context, 'fields', {})
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет в запись контекст текущего обновления (update_id, chat_id, state)"""
+
+    def filter(self, record):
+        for name, value in get_context().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей высокочастотных событий (extra={'event': ...})"""
+
+    def __init__(self, rate=1.0, events=('handler', 'crm_request')):
+        super().__init__()
+        self.rate = rate
+        self.events = frozenset(events)
+
+    def filter(self, record):
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        if getattr(record, 'event', None) not in self.events:
+            return True
+        return random.random() < self.rate
+
+
+class RedactingFormatter(logging.Formatter):
+    """Текстовый формат с маскированием телефонов в сообщении и трассировке"""
+
+    def formatMessage(self, record):
+        record.message = redact_phones(record.message)
+        return super().formatMessage(record)
+
+    def formatException(self, exc_info):
+        return redact_phones(super().formatException(exc_info))
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; номера телефонов маскируются"""
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact_phones(record.getMessage()),
+        }
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info:
+            data['exc'] = redact_phones(self.formatException(record.exc_info))
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь без форматирования: строку соберет поток-слушатель"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level='INFO', fmt='json', sample_rate=1.0, stream=None):
+    """Настраивает асинхронный вывод логов через очередь; возвращает QueueListener"""
+    global _listener
+    shutdown_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else RedactingFormatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    _listener = listener
+    return listener
+
+
+@atexit.register
+def shutdown_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток-слушатель"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def handler_context(state):
+    """Декоратор обработчика: привязывает к логам update_id, chat_id и состояние и пишет длительность"""
+    def decorator(func):
+        log = logging.getLogger(func.__module__)
+
+        @functools.wraps(func)
+        def wrapper(update, *args, **kwargs):
+            previous = get_context()
+            chat = getattr(update, 'effective_chat', None)
+            _context.fields = {
+                'update_id': getattr(update, 'update_id', None),
+                'chat_id': chat.id if chat else None,
+                'state': state,
+            }
+            started = time.perf_counter()
+            try:
+                return func(update, *args, **kwargs)
+            finally:
+                duration_ms = round((time.perf_counter() - started) * 1000, 2)
+                log.info("Обработчик %s завершен за %s мс", state, duration_ms,
+                         extra={'event': 'handler', 'duration_ms': duration_ms})
+                _context.fields = previous
+        return wrapper
+    return decorator
@@ -1,31 +1,125 @@
 import os
 import logging
 import re
+import threading
 import time
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackContext
-from telegram.error import TelegramError
+from telegram.ext import CommandHandler, MessageHandler, TypeHandler, Filters, ConversationHandler, CallbackContext
 import requests
-from bs4 import BeautifulSoup
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+import crm_transport
+import log_setup
+import metrics
+import send_scheduler
+from catalog import Catalog, required_mask
+from circuit_breaker import CircuitBreaker, AdaptiveTimeout, STATES as CIRCUIT_STATES
+from crm_outbox import CrmOutbox
+from lead_dedup import LeadDeduplicator
+import chat_executor
+from session_store import SessionStore, SqliteSessionBackend
+from survey_router import SurveyRouter
+from shared_state import MemoryConversations, SharedPersistence, SqliteConversationStore
+
 logger = logging.getLogger(__name__)
 
 # Токен бота из переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
-# Проверяем токен
-if not BOT_TOKEN:
-    logger.error("❌ Токен бота не найден! Установите переменную окружения BOT_TOKEN")
-    exit(1)
+# Режим работы: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8080')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# Число потоков для параллельной обработки разных чатов (0 - последовательно)
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '0'))
+
+# Порт для метрик Prometheus и /debug/memory (только здесь: порт вебхука открыт наружу)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Флуд-лимиты Telegram для планировщика исходящих сообщений
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+
+# Число процессов-обработчиков (больше 1 - режим кластера, нужен SESSION_DB_PATH)
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+
+# Адрес Bot API (можно указать локальную заглушку для тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Файл для записи входящих обновлений и ответов CRM (для replay.py), по умолчанию выключено
+RECORD_PATH = os.getenv('RECORD_PATH')
+
+# Адрес веб-формы CRM
+CRM_FORM_URL = os.getenv('CRM_FORM_URL', 'https://ya7auto.ru/crm/form/iframe/3/')
 
 # Состояния диалога
 AUTOSTART, CONTROL, GPS, PHONE = range(4)
-user_data = {}
+
+# Кнопки опроса: текст кнопки -> значение ответа
+AUTOSTART_BUTTONS = {'С автозапуском': 1, 'БЕЗ автозапуска': 0}
+CONTROL_BUTTONS = {'😎 Приложение в телефоне': 'app', '📺 Брелок': 'remote'}
+GPS_BUTTONS = {'Да, нужен GPS': 1, 'Нет, не нужен': 0}
+MANUAL_PHONE_BUTTON = "Ввести номер вручную"
+CANCEL_BUTTON = "Отмена"
+
+# Клавиатуры создаются один раз, а не на каждый ответ
+AUTOSTART_KEYBOARD = ReplyKeyboardMarkup([list(AUTOSTART_BUTTONS)], one_time_keyboard=True, resize_keyboard=True)
+CONTROL_KEYBOARD = ReplyKeyboardMarkup([list(CONTROL_BUTTONS)], one_time_keyboard=True, resize_keyboard=True)
+GPS_KEYBOARD = ReplyKeyboardMarkup([list(GPS_BUTTONS)], one_time_keyboard=True, resize_keyboard=True)
+PHONE_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📞 Отправить мой номер", request_contact=True)], [MANUAL_PHONE_BUTTON]],
+    one_time_keyboard=True,
+    resize_keyboard=True
+)
+MANUAL_PHONE_KEYBOARD = ReplyKeyboardMarkup([[CANCEL_BUTTON]], resize_keyboard=True)
+EMPTY_KEYBOARD = ReplyKeyboardMarkup([[]], resize_keyboard=True)
+
+# Тексты вопросов
+START_TEXT = (
+    "Готов помочь подобрать идеальную систему для твоего автомобиля!\n\n"
+    "🦾 Давай определимся с ключевыми функциями\n\n"
+    "☀️ Подавляющее большинство наших клиентов выбирают систему с главной целью — реализовать дистанционный запуск двигателя.\n\n"
+    "В нашем климате прогрев двигателя перед поездкой — это необходимость. Даже при небольшом минусе это значительно снижает износ мотора.\n\n"
+    "Ну и конечно, садиться в уже тёплый и комфортный салон — это просто приятно.\n\n"
+    "Какая функция для вас в приоритете?"
+)
+CONTROL_TEXT = (
+    "📡 Теперь давай выберем способ управления\n\n"
+    "🙄 Есть устаревший метод — управление с брелока сигнализации. Его минус в нестабильном сигнале: есть риск не получить оповещение о тревоге. Поэтому мы рекомендуем более современный вариант — управление со смартфона.\n\n"
+    "☺️ Через мобильное приложение ты сможешь дистанционно открывать и закрывать авто, отслеживать его местоположение и статус, настраивать датчики и многое другое. Главное — ты гарантированно получишь пуш-уведомление о любом происшествии, где бы ты ни был.\n\n"
+    "Как вам удобнее управлять системой?"
+)
+GPS_TEXT = (
+    "🔥 Отлично! Мы почти подобрали твою идеальную систему. Остался последний шаг.\n\n"
+    "Если ты часто передаешь ключи другим людям или тебе критично важно отслеживать каждое перемещение автомобиля, то тебе нужна система со встроенным GPS-модулем.\n\n"
+    "Он позволит тебе в реальном времени видеть точное местоположение машины, а в приложении можно будет посмотреть детальный маршрут ее поездки.\n\n"
+    "Нужен ли вам GPS-модуль для отслеживания?"
+)
+PHONE_TEXT = "Пожалуйста, отправьте ваш номер телефона. Используйте кнопку ниже для удобства."
+MANUAL_PHONE_TEXT = "Пожалуйста, введите ваш номер телефона в формате +7XXX..."
+INVALID_PHONE_TEXT = "Неверный формат номера. Пожалуйста, введите номер в формате +7XXX..."
+DUPLICATE_LEAD_TEXT = (
+    "✅ Ваша заявка уже принята, менеджер свяжется с вами в ближайшее время!\n\n"
+    "Для нового подбора нажмите /start"
+)
+LEAD_ACCEPTED_TEXT = (
+    "✅ Спасибо! Ваши данные приняты и отправлены менеджеру. Мы свяжемся с вами в ближайшее время!\n\n"
+    "Для нового подбора нажмите /start"
+)
+LEAD_FAILED_TEXT = (
+    "❌ Произошла ошибка при отправке данных. Пожалуйста, попробуйте позже или свяжитесь с нами по телефону.\n\n"
+    "Для повторной попытки нажмите /start"
+)
+CANCEL_TEXT = 'Диалог прерван. Если нужна помощь, начните заново с /start.'
+
+# Ответы пользователей: ограниченное хранилище с TTL и LRU вместо вечного словаря
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH')
+SESSION_MAX_SIZE = int(os.getenv('SESSION_MAX_SIZE', '10000'))
 
 # Список продуктов
 PRODUCTS_DATA = [
@@ -51,10 +145,75 @@ PRODUCTS_DATA = [
      'link': 'https://ya7auto.ru/auto-security/car-alarms/starline-s96-v2-lte-gps/'}
 ]
 
+# Индекс рекомендаций; CATALOG_PATH позволяет подменять каталог без перезапуска
+CATALOG_PATH = os.getenv('CATALOG_PATH')
+
+# Период синхронизации каталога с сайтом в секундах (0 - выключена, нужен CATALOG_PATH)
+CATALOG_SYNC_INTERVAL = int(os.getenv('CATALOG_SYNC_INTERVAL', '0'))
+
+
+# Выключатель CRM и адаптивный таймаут чтения
+CRM_BREAKER_THRESHOLD = int(os.getenv('CRM_BREAKER_THRESHOLD', '5'))
+CRM_BREAKER_RESET = float(os.getenv('CRM_BREAKER_RESET', '30'))
+CRM_MIN_READ_TIMEOUT = float(os.getenv('CRM_MIN_READ_TIMEOUT', '2'))
+
+# Очередь заявок в CRM
+CRM_OUTBOX_PATH = os.getenv('CRM_OUTBOX_PATH', 'crm_outbox.db')
+CRM_OUTBOX_WORKERS = int(os.getenv('CRM_OUTBOX_WORKERS', '2'))
+
+# Защита от повторных заявок
+LEAD_DEDUP_WINDOW = float(os.getenv('LEAD_DEDUP_WINDOW', '86400'))
+LEAD_DEDUP_MAX_SIZE = int(os.getenv('LEAD_DEDUP_MAX_SIZE', '50000'))
+LEAD_DEDUP_PATH = os.getenv('LEAD_DEDUP_PATH')
+
+# Контроль памяти (лимит контейнера 512Mi): при превышении мягкого лимита сбрасываем кеши.
+# Включается MEMORY_SOFT_LIMIT_MB и/или MEMORY_TRACE_FRAMES (снимки tracemalloc)
+MEMORY_SOFT_LIMIT_MB = int(os.getenv('MEMORY_SOFT_LIMIT_MB', '0'))
+MEMORY_TRACE_FRAMES = int(os.getenv('MEMORY_TRACE_FRAMES', '0'))
+MEMORY_CHECK_INTERVAL = float(os.getenv('MEMORY_CHECK_INTERVAL', '30'))
+# Повторный сброс - не раньше, чем через столько секунд, если RSS так и не опустился ниже 90% лимита
+MEMORY_SHED_COOLDOWN = float(os.getenv('MEMORY_SHED_COOLDOWN', '600'))
+# Сессии без активности дольше этого времени выгружаются из памяти при сбросе
+MEMORY_IDLE_SESSION = float(os.getenv('MEMORY_IDLE_SESSION', '1800'))
+
+# Состояние процесса создается в setup(): хранилища, клиенты CRM, контроль памяти
+user_data = None
+catalog = None
+crm_breaker = None
+crm_timeout = None
+crm_outbox = None
+lead_dedup = None
+memory_budget = None
+recorder = None
+
+# Планировщик исходящих сообщений, создается при запуске бота
+outgoing = None
+
+
+def setup_logging():
+    """Логи пишутся асинхронно через очередь, телефоны в них маскируются"""
+    log_setup.setup_logging(
+        level=os.getenv('LOG_LEVEL', 'INFO'),
+        fmt=os.getenv('LOG_FORMAT', 'json'),
+        sample_rate=float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+    )
+
+
+def check_crm_health():
+    """Легкая проверка доступности сайта CRM для выключателя"""
+    response = crm_transport.request(
+        'HEAD', crm_transport.CRM_BASE_URL, timeout=(crm_transport.CONNECT_TIMEOUT, 5), allow_redirects=False
+    )
+    return response.status_code < 500
+
 
 def send_to_crm(phone_number, user_name=None):
-    """Отправляет данные в CRM через веб-форму с правильными ID полей"""
-    url = "https://ya7auto.ru/crm/form/iframe/3/"
+    """Отправляет данные в CRM через веб-форму с правильными ID полей.
+
+    Пока выключатель CRM разомкнут, сразу бросает CircuitOpenError:
+    очередь заявок откладывает лид, не тратя попытку.
+    """
+    crm_breaker.before_call()
 
     # Если имя не указано, используем "Клиент из Telegram"
     if not user_name:
@@ -71,35 +230,132 @@ def send_to_crm(phone_number, user_name=None):
         'comment': 'Заявка из Telegram-бота по подбору автосигнализаций'
     }
 
-    # Заголовки как у браузера
+    # Браузерные заголовки уже заданы в общей сессии crm_transport
     headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
         'Content-Type': 'application/x-www-form-urlencoded',
         'Referer': 'https://ya7auto.ru/',
     }
 
+    read_timeout = crm_timeout.current()
+    started = time.perf_counter()
     try:
-        logger.info(f"Отправка данных в CRM: {form_data}")
+        logger.info("Отправка заявки в CRM: %s, телефон %s", form_data['firstname'], phone_number,
+                    extra={'event': 'crm_request'})
+
+        # Отправляем POST запрос через общий пул соединений
+        response = crm_transport.post(
+            CRM_FORM_URL, data=form_data, headers=headers, timeout=(crm_transport.CONNECT_TIMEOUT, read_timeout)
+        )
 
-        # Отправляем POST запрос с данными формы
-        response = requests.post(url, data=form_data, headers=headers, timeout=15)
+        logger.info("Ответ CRM: %s", response.status_code, extra={'event': 'crm_request'})
+        if recorder is not None:
+            recorder.record_crm(response.status_code, time.perf_counter() - started)
 
-        logger.info(f"Ответ CRM: {response.status_code}")
+        # Ошибки 5xx считаем сбоем сервиса, остальные ответы - признаком того, что он жив
+        if response.status_code >= 500:
+            crm_breaker.record_failure()
+        else:
+            crm_breaker.record_success()
+            crm_timeout.observe(time.perf_counter() - started)
 
         # Проверяем успешность по статусу коду
         if response.status_code == 200:
-            logger.info(f"✅ Данные успешно отправлены в CRM")
+            metrics.observe_crm(time.perf_counter() - started, 'success')
+            logger.info("✅ Данные успешно отправлены в CRM")
             return True
         else:
-            logger.error(f"❌ Ошибка отправки формы: {response.status_code}")
+            metrics.observe_crm(time.perf_counter() - started, 'http_error')
+            logger.error("❌ Ошибка отправки формы: %s", response.status_code)
             return False
 
     except Exception as e:
-        logger.error(f"💥 Исключение при отправке в CRM: {str(e)}")
+        if isinstance(e, requests.Timeout):
+            # Учитываем таймаут как наблюдение, чтобы адаптивный таймаут рос вслед за CRM
+            crm_timeout.observe(read_timeout)
+        crm_breaker.record_failure()
+        if recorder is not None:
+            recorder.record_crm(None, time.perf_counter() - started)
+        metrics.observe_crm(time.perf_counter() - started, 'exception')
+        logger.error("💥 Исключение при отправке в CRM: %s", e)
         return False
 
 
+def forget_failed_lead(phone_number, user_id):
+    """Очередь отказалась от заявки: разрешаем пользователю отправить номер снова"""
+    if user_id is not None:
+        lead_dedup.forget(user_id, phone_number)
+
+
+def setup(session_max_size=None, outbox_poll_interval=None, dedup_path=None):
+    """Создает хранилища, клиенты CRM и контроль памяти процесса.
+
+    Вызывается один раз в каждом процессе, который обрабатывает обновления
+    (main() или процесс кластера), а не при импорте модуля.
+    """
+    global user_data, catalog, crm_breaker, crm_timeout, crm_outbox, lead_dedup, memory_budget, recorder
+
+    # Ответы пользователей: ограниченное хранилище с TTL и LRU вместо вечного словаря
+    user_data = SessionStore(
+        max_size=SESSION_MAX_SIZE if session_max_size is None else session_max_size,
+        ttl=SESSION_TTL,
+        backend=SqliteSessionBackend(SESSION_DB_PATH) if SESSION_DB_PATH else None
+    )
+    metrics.ACTIVE_SESSIONS.collect = user_data.active_count
+
+    catalog = Catalog(PRODUCTS_DATA, path=CATALOG_PATH)
+
+    # Выключатель и адаптивный таймаут для CRM: при недоступности сайта не ждем по 15 секунд
+    crm_breaker = CircuitBreaker(
+        'crm',
+        failure_threshold=CRM_BREAKER_THRESHOLD,
+        reset_timeout=CRM_BREAKER_RESET,
+        probe=check_crm_health
+    )
+    crm_timeout = AdaptiveTimeout(minimum=CRM_MIN_READ_TIMEOUT, maximum=crm_transport.READ_TIMEOUT)
+    metrics.CRM_CIRCUIT_STATE.collect = lambda: {(state,): int(state == crm_breaker.state) for state in CIRCUIT_STATES}
+    metrics.CRM_READ_TIMEOUT.collect = crm_timeout.current
+
+    # Защита от повторных заявок: тот же номер от того же пользователя в пределах окна
+    lead_dedup = LeadDeduplicator(
+        window=LEAD_DEDUP_WINDOW,
+        max_size=LEAD_DEDUP_MAX_SIZE,
+        path=LEAD_DEDUP_PATH if dedup_path is None else dedup_path
+    )
+
+    # Очередь заявок: get_phone только сохраняет лид, отправка идет в фоне.
+    # Если заявку так и не удалось отправить, повторная попытка пользователя не считается дублем
+    crm_outbox = CrmOutbox(
+        CRM_OUTBOX_PATH,
+        send_to_crm,
+        workers=CRM_OUTBOX_WORKERS,
+        poll_interval=outbox_poll_interval,
+        on_failed=forget_failed_lead
+    )
+    metrics.OUTBOX_PENDING.collect = crm_outbox.pending_count
+    metrics.OUTBOX_FAILED.collect = crm_outbox.failed_count
+
+    # Контроль памяти: при превышении мягкого лимита сбрасываем кеши.
+    # Модуль (tracemalloc, снимки) загружаем, только если контроль включен
+    memory_budget = None
+    if MEMORY_SOFT_LIMIT_MB or MEMORY_TRACE_FRAMES:
+        from memory_guard import MemoryGuard, read_rss
+        memory_budget = MemoryGuard(
+            soft_limit=MEMORY_SOFT_LIMIT_MB * 1024 * 1024,
+            interval=MEMORY_CHECK_INTERVAL,
+            trace_frames=MEMORY_TRACE_FRAMES,
+            shed_cooldown=MEMORY_SHED_COOLDOWN
+        )
+        memory_budget.add_shedder('sessions_expired', user_data.purge_expired)
+        memory_budget.add_shedder('sessions_idle', lambda: user_data.evict_idle(MEMORY_IDLE_SESSION))
+        memory_budget.add_shedder('lead_dedup', lead_dedup.purge_expired)
+        memory_budget.add_shedder('crm_connections', crm_transport.close)
+        metrics.MEMORY_RSS.collect = lambda: read_rss() or 0
+
+    if RECORD_PATH:
+        from update_recorder import UpdateRecorder
+        recorder = UpdateRecorder(RECORD_PATH)
+
+
 def validate_phone_number(phone):
     """Проверяет и форматирует номер телефона"""
     digits = re.sub(r'\D', '', str(phone))
@@ -115,110 +371,74 @@ def validate_phone_number(phone):
     return None
 
 
+def reply(update: Update, text, priority=None, **kwargs):
+    """Отвечает в чат через планировщик отправки (или напрямую, если он не запущен)"""
+    if outgoing is None:
+        return update.message.reply_text(text, **kwargs)
+    if priority is None:
+        priority = send_scheduler.NORMAL
+    return outgoing.send(update.effective_chat.id, text, priority=priority, **kwargs)
+
+
+@metrics.timed('start')
+@log_setup.handler_context('start')
 def start(update: Update, context: CallbackContext) -> int:
     """Начинает опрос, задает первый вопрос."""
     user = update.message.from_user
-    update.message.reply_text(
-        f"👋🏻 Приветствуем, {user.first_name}!\n\n"
-        "Готов помочь подобрать идеальную систему для твоего автомобиля!\n\n"
-        "🦾 Давай определимся с ключевыми функциями\n\n"
-        "☀️ Подавляющее большинство наших клиентов выбирают систему с главной целью — реализовать дистанционный запуск двигателя.\n\n"
-        "В нашем климате прогрев двигателя перед поездкой — это необходимость. Даже при небольшом минусе это значительно снижает износ мотора.\n\n"
-        "Ну и конечно, садиться в уже тёплый и комфортный салон — это просто приятно.\n\n"
-        "Какая функция для вас в приоритете?",
-        reply_markup=ReplyKeyboardMarkup(
-            [["С автозапуском", "БЕЗ автозапуска"]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        ),
-    )
+    metrics.funnel('start')
+    reply(update, f"👋🏻 Приветствуем, {user.first_name}!\n\n{START_TEXT}", reply_markup=AUTOSTART_KEYBOARD)
     return AUTOSTART
 
 
-def autostart_choice(update: Update, context: CallbackContext) -> int:
+@metrics.timed('autostart_choice')
+@log_setup.handler_context('autostart')
+def autostart_choice(update: Update, context: CallbackContext, autostart: int) -> int:
     """Обрабатывает выбор автозапуска и задает второй вопрос."""
-    choice = update.message.text
-    user_id = update.message.from_user.id
-    user_data[user_id] = {'autostart': 1 if choice == 'С автозапуском' else 0}
-
-    update.message.reply_text(
-        "📡 Теперь давай выберем способ управления\n\n"
-        "🙄 Есть устаревший метод — управление с брелока сигнализации. Его минус в нестабильном сигнале: есть риск не получить оповещение о тревоге. Поэтому мы рекомендуем более современный вариант — управление со смартфона.\n\n"
-        "☺️ Через мобильное приложение ты сможешь дистанционно открывать и закрывать авто, отслеживать его местоположение и статус, настраивать датчики и многое другое. Главное — ты гарантированно получишь пуш-уведомление о любом происшествии, где бы ты ни был.\n\n"
-        "Как вам удобнее управлять системой?",
-        reply_markup=ReplyKeyboardMarkup(
-            [["😎 Приложение в телефоне", "📺 Брелок"]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        ),
-    )
+    user_data.reset(update.message.from_user.id, autostart=autostart)
+    metrics.funnel('autostart')
+
+    reply(update, CONTROL_TEXT, reply_markup=CONTROL_KEYBOARD)
     return CONTROL
 
 
-def control_choice(update: Update, context: CallbackContext) -> int:
+@metrics.timed('control_choice')
+@log_setup.handler_context('control')
+def control_choice(update: Update, context: CallbackContext, control: str) -> int:
     """Обрабатывает выбор управления и задает третий вопрос."""
-    choice = update.message.text
     user_id = update.message.from_user.id
-    user_data[user_id]['control'] = 'app' if 'Приложение' in choice else 'remote'
-
-    update.message.reply_text(
-        "🔥 Отлично! Мы почти подобрали твою идеальную систему. Остался последний шаг.\n\n"
-        "Если ты часто передаешь ключи другим людям или тебе критично важно отслеживать каждое перемещение автомобиля, то тебе нужна система со встроенным GPS-модулем.\n\n"
-        "Он позволит тебе в реальном времени видеть точное местоположение машины, а в приложении можно будет посмотреть детальный маршрут ее поездки.\n\n"
-        "Нужен ли вам GPS-модуль для отслеживания?",
-        reply_markup=ReplyKeyboardMarkup(
-            [["Да, нужен GPS", "Нет, не нужен"]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        ),
-    )
+    if user_data.get(user_id) is None:
+        # Сессия устарела - начинаем опрос заново
+        return start(update, context)
+    user_data.update(user_id, control=control)
+    metrics.funnel('control')
+
+    reply(update, GPS_TEXT, reply_markup=GPS_KEYBOARD)
     return GPS
 
 
-def gps_choice(update: Update, context: CallbackContext) -> int:
+@metrics.timed('gps_choice')
+@log_setup.handler_context('gps')
+def gps_choice(update: Update, context: CallbackContext, gps: int) -> int:
     """Обрабатывает выбор GPS, показывает рекомендацию и запрашивает телефон."""
-    choice = update.message.text
     user_id = update.message.from_user.id
-    user_data[user_id]['gps'] = 1 if 'Да' in choice else 0
-
-    user_prefs = user_data[user_id]
-    recommended_products = []
-
-    # Логика подбора
-    for product in PRODUCTS_DATA:
-        if user_prefs['autostart'] == 1 and product['autostart'] == 0:
-            continue
-        if user_prefs['control'] == 'app' and product['gsm'] == 0:
-            continue
-        if user_prefs['gps'] == 1 and product['gps'] == 0:
-            continue
-
-        recommended_products.append(product)
-        if len(recommended_products) == 2:
-            break
-
-    # Формируем сообщение с рекомендациями
-    if recommended_products:
-        message_text = "Вот отличные варианты для вас:\n\n"
-        for prod in recommended_products:
-            message_text += f"• <a href='{prod['link']}'>{prod['name']}</a>\n"
-        message_text += "\nДля подробного обсуждения и оформления заказа оставьте, пожалуйста, ваш номер телефона. Наш специалист свяжется с вами в ближайшее время."
-    else:
-        message_text = "К сожалению, по вашим запросам не найдено подходящих систем. Оставьте ваш номер телефона, и наш специалист поможет вам с подбором вручную."
-
-    update.message.reply_text(message_text, parse_mode='HTML', disable_web_page_preview=True)
-
-    update.message.reply_text(
-        "Пожалуйста, отправьте ваш номер телефона. Используйте кнопку ниже для удобства.",
-        reply_markup=ReplyKeyboardMarkup(
-            [[KeyboardButton("📞 Отправить мой номер", request_contact=True)], ["Ввести номер вручную"]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        ),
-    )
+    if user_data.get(user_id) is None:
+        # Сессия устарела - начинаем опрос заново
+        return start(update, context)
+    user_prefs = user_data.update(user_id, gps=gps)
+    metrics.funnel('gps')
+
+    # Подбор и текст сообщения берем из предрасчитанного индекса
+    required = required_mask(user_prefs.autostart, user_prefs.control, user_prefs.gps)
+    message_text = catalog.index.message(required)
+
+    # Планировщик склеит рекомендацию и просьбу о телефоне в одно сообщение
+    reply(update, message_text, parse_mode='HTML', disable_web_page_preview=True)
+    reply(update, PHONE_TEXT, reply_markup=PHONE_KEYBOARD)
     return PHONE
 
 
+@metrics.timed('get_phone')
+@log_setup.handler_context('phone')
 def get_phone(update: Update, context: CallbackContext) -> int:
     """Обрабатывает полученный контакт и отправляет его в CRM."""
     phone_number = None
@@ -227,47 +447,51 @@ def get_phone(update: Update, context: CallbackContext) -> int:
 
     if update.message.contact:
         phone_number = validate_phone_number(update.message.contact.phone_number)
-    elif update.message.text == "Ввести номер вручную":
-        update.message.reply_text(
-            "Пожалуйста, введите ваш номер телефона в формате +7XXX...",
-            reply_markup=ReplyKeyboardMarkup([["Отмена"]], resize_keyboard=True)
-        )
+    elif update.message.text == MANUAL_PHONE_BUTTON:
+        reply(update, MANUAL_PHONE_TEXT, reply_markup=MANUAL_PHONE_KEYBOARD)
         return PHONE
-    elif update.message.text != "Отмена":
+    elif update.message.text != CANCEL_BUTTON:
         phone_number = validate_phone_number(update.message.text)
 
     if not phone_number:
-        update.message.reply_text("Неверный формат номера. Пожалуйста, введите номер в формате +7XXX...")
+        reply(update, INVALID_PHONE_TEXT)
         return PHONE
 
-    # Показываем что идет отправка
-    update.message.reply_text("⌛ Отправляем ваши данные в CRM...")
-
-    # Отправляем в CRM (имя и телефон)
-    success = send_to_crm(phone_number, user_name)
+    # Повторную заявку отвечаем сами, не создавая новый лид в CRM
+    if not lead_dedup.check_and_remember(user.id, phone_number):
+        logger.info("🔁 Повторная заявка от пользователя %s, в CRM не отправляем", user.id)
+        metrics.DUPLICATE_LEADS.inc()
+        user_data.delete(user.id)
+        reply(update, DUPLICATE_LEAD_TEXT, priority=send_scheduler.CONFIRMATION, reply_markup=EMPTY_KEYBOARD)
+        return ConversationHandler.END
 
-    if success:
-        update.message.reply_text(
-            "✅ Спасибо! Ваши данные приняты и отправлены менеджеру. Мы свяжемся с вами в ближайшее время!\n\n"
-            "Для нового подбора нажмите /start",
-            reply_markup=ReplyKeyboardMarkup([[]], resize_keyboard=True)
-        )
-    else:
-        update.message.reply_text(
-            "❌ Произошла ошибка при отправке данных. Пожалуйста, попробуйте позже или свяжитесь с нами по телефону.\n\n"
-            "Для повторной попытки нажмите /start",
-            reply_markup=ReplyKeyboardMarkup([[]], resize_keyboard=True)
-        )
+    # Сохраняем заявку в очередь, в CRM она уйдет в фоне
+    try:
+        crm_outbox.enqueue(phone_number, user_name, user_id=user.id)
+        metrics.funnel('phone')
+        success = True
+    except Exception as e:
+        logger.error("💥 Не удалось сохранить заявку в очередь: %s", e)
+        lead_dedup.forget(user.id, phone_number)
+        success = False
+
+    # Опрос завершен, ответы больше не нужны
+    user_data.delete(user.id)
+
+    reply(
+        update,
+        LEAD_ACCEPTED_TEXT if success else LEAD_FAILED_TEXT,
+        priority=send_scheduler.CONFIRMATION,
+        reply_markup=EMPTY_KEYBOARD
+    )
 
     return ConversationHandler.END
 
 
 def cancel(update: Update, context: CallbackContext) -> int:
     """Отменяет опрос."""
-    update.message.reply_text(
-        'Диалог прерван. Если нужна помощь, начните заново с /start.',
-        reply_markup=ReplyKeyboardMarkup([[]], resize_keyboard=True)
-    )
+    user_data.delete(update.message.from_user.id)
+    reply(update, CANCEL_TEXT, reply_markup=EMPTY_KEYBOARD)
     return ConversationHandler.END
 
 
@@ -276,40 +500,181 @@ def error_handler(update: Update, context: CallbackContext):
     logger.error("Ошибка:", exc_info=context.error)
 
 
-def main():
-    """Запускает бота в polling режиме"""
-    logger.info("🚀 Запуск бота в polling режиме...")
-
-    # Создаем Updater (старая версия PTB)
-    updater = Updater(BOT_TOKEN, use_context=True)
+def build_router():
+    """Таблица кнопок опроса: точный текст кнопки сразу дает обработчик и ответ"""
+    router = SurveyRouter()
+    router.add_buttons(AUTOSTART, AUTOSTART_BUTTONS, autostart_choice)
+    router.add_buttons(CONTROL, CONTROL_BUTTONS, control_choice)
+    router.add_buttons(GPS, GPS_BUTTONS, gps_choice)
+    return router
 
-    # Получаем dispatcher для регистрации обработчиков
-    dp = updater.dispatcher
-    dp.add_error_handler(error_handler)
 
-    # Обработчик диалога
-    conv_handler = ConversationHandler(
+def build_conversation_handler():
+    """Собирает обработчик диалога опроса"""
+    router = build_router()
+    survey = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            AUTOSTART: [MessageHandler(Filters.regex('^(С автозапуском|БЕЗ автозапуска)$'), autostart_choice)],
-            CONTROL: [MessageHandler(Filters.regex('^(😎 Приложение в телефоне|📺 Брелок)$'), control_choice)],
-            GPS: [MessageHandler(Filters.regex('^(Да, нужен GPS|Нет, не нужен)$'), gps_choice)],
+            AUTOSTART: [router.handler(AUTOSTART)],
+            CONTROL: [router.handler(CONTROL)],
+            GPS: [router.handler(GPS)],
             PHONE: [
                 MessageHandler(Filters.contact, get_phone),
                 MessageHandler(Filters.text & ~Filters.command, get_phone)
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        # /start всегда начинает опрос заново, даже если пользователь застрял на каком-то шаге
+        allow_reentry=True,
+        name='survey',
+        persistent=bool(SESSION_DB_PATH),
     )
+    # Без conversation_timeout: он ставит и снимает задачу планировщика на каждом обновлении.
+    # Брошенные диалоги раз в 10 минут удаляет create_updater (с persistence словарь подменит диспетчер)
+    survey.conversations = MemoryConversations()
+    return survey
+
+
+def create_updater(token, base_url=None):
+    """Создает Updater со всеми обработчиками бота"""
+    # Состояние диалогов храним рядом с сессиями: опрос переживает передеплой,
+    # а в режиме кластера его может продолжить любой процесс
+    persistence = None
+    if SESSION_DB_PATH:
+        persistence = SharedPersistence(SqliteConversationStore(SESSION_DB_PATH))
 
-    dp.add_handler(conv_handler)
+    # Создаем Updater (старая версия PTB) с диспетчером, умеющим обрабатывать чаты параллельно
+    updater = chat_executor.create_updater(token, base_url, persistence=persistence)
+
+    # Получаем dispatcher для регистрации обработчиков
+    dp = updater.dispatcher
+    dp.add_error_handler(error_handler)
+    if recorder is not None:
+        # Записываем обновления до обработки, в отдельной группе
+        dp.add_handler(TypeHandler(Update, recorder.record_update), group=-1)
+    survey = build_conversation_handler()
+    dp.add_handler(survey)
+
+    # Периодически чистим устаревшие сессии и кеш повторных заявок
+    updater.job_queue.run_repeating(lambda context: user_data.purge_expired(), interval=600, first=600)
+    # Диалоги без движения дольше SESSION_TTL завершаем вместе с их сессиями
+    updater.job_queue.run_repeating(
+        lambda context: survey.conversations.purge_expired(time.time() - SESSION_TTL), interval=600, first=600
+    )
+    updater.job_queue.run_repeating(lambda context: lead_dedup.purge_expired(), interval=3600, first=3600)
+    return updater
+
+
+def start_services(updater, outbox=True, send_global_rate=SEND_GLOBAL_RATE, metrics_port=METRICS_PORT,
+                   catalog_sync=True):
+    """Запускает фоновые службы; возвращает функцию их остановки.
+
+    В кластере очередь CRM (outbox) и синхронизацию каталога (catalog_sync)
+    запускает только один процесс; остальные подхватывают файл каталога.
+    """
+    global outgoing
+
+    # Ответы пользователям идут через планировщик с учетом флуд-лимитов
+    outgoing = send_scheduler.SendScheduler(
+        updater.bot,
+        global_rate=send_global_rate,
+        chat_rate=SEND_CHAT_RATE,
+        chat_burst=SEND_CHAT_BURST
+    )
+    outgoing.start()
+
+    # Разные чаты обрабатываем параллельно, сообщения одного чата - строго по порядку
+    executor = chat_executor.install(updater.dispatcher, UPDATE_WORKERS) if UPDATE_WORKERS > 0 else None
+
+    # Прогреваем соединение с CRM и запускаем фоновую отправку заявок
+    threading.Thread(target=crm_transport.warm_up, args=(CRM_FORM_URL,), daemon=True).start()
+    if outbox:
+        crm_outbox.start()
+        crm_breaker.start_probing()
+
+    # Замеры памяти и отчет на /debug/memory (только сервер метрик: вебхук доступен извне)
+    memory_enabled = memory_budget is not None
+    if memory_enabled:
+        metrics.DEBUG_PAGES['/debug/memory'] = memory_budget.render
+        memory_budget.start()
+
+    metrics_server = metrics.start_http_server(metrics_port) if metrics_port else None
+
+    # Каталог обновляется в фоне и подменяется целиком, не затрагивая обработчики.
+    # После синхронизации индекс перестраивается из записанного файла в потоке
+    # синхронизации, а его mtime запоминается, чтобы наблюдатель не пересобрал индекс повторно
+    catalog.start_watching()
+    syncer = None
+    if catalog_sync and CATALOG_PATH and CATALOG_SYNC_INTERVAL > 0:
+        from catalog_sync import CatalogSync
+        syncer = CatalogSync(
+            CATALOG_PATH, PRODUCTS_DATA, on_update=lambda products: catalog.maybe_reload(force=True)
+        )
+        syncer.start(CATALOG_SYNC_INTERVAL)
+
+    def stop_services():
+        if executor:
+            executor.shutdown()
+        outgoing.stop(timeout=10)
+        if outbox:
+            crm_outbox.stop(timeout=5)
+            crm_breaker.stop_probing()
+        crm_transport.close()
+        if metrics_server:
+            metrics_server.shutdown()
+        catalog.stop_watching()
+        if syncer:
+            syncer.stop()
+        if memory_enabled:
+            memory_budget.stop()
+
+    return stop_services
+
+
+def main():
+    """Запускает бота в polling или webhook режиме"""
+    setup_logging()
+
+    # Проверяем токен
+    if not BOT_TOKEN:
+        logger.error("❌ Токен бота не найден! Установите переменную окружения BOT_TOKEN")
+        exit(1)
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        logger.error("❌ Для режима webhook задайте переменную окружения WEBHOOK_URL")
+        exit(1)
+
+    if BOT_WORKERS > 1:
+        # Мастер кластера получает обновления polling'ом и удалил бы рабочий вебхук
+        if BOT_MODE == 'webhook':
+            logger.error("❌ Режим кластера (BOT_WORKERS > 1) несовместим с BOT_MODE=webhook")
+            exit(1)
+        if not SESSION_DB_PATH:
+            logger.error("❌ Для нескольких процессов задайте общее хранилище SESSION_DB_PATH")
+            exit(1)
+        logger.info("🚀 Запуск бота в режиме кластера из %s процессов...", BOT_WORKERS)
+        from cluster import Cluster
+        Cluster(BOT_TOKEN, BOT_WORKERS, TELEGRAM_API_URL).run()
+        return
+
+    logger.info("🚀 Запуск бота в %s режиме...", BOT_MODE)
+
+    setup()
+    updater = create_updater(BOT_TOKEN, TELEGRAM_API_URL)
+    stop_services = start_services(updater)
+
+    if BOT_MODE == 'webhook':
+        # Принимаем обновления встроенным HTTP-сервером до остановки
+        from webhook_server import run_webhook
+        run_webhook(updater, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+    else:
+        # Запускаем polling
+        logger.info("✅ Бот запущен и ожидает сообщений...")
+        updater.start_polling()
 
-    # Запускаем polling
-    logger.info("✅ Бот запущен и ожидает сообщений...")
-    updater.start_polling()
+        # Запускаем бота до принудительной остановки
+        updater.idle()
 
-    # Запускаем бота до принудительной остановки
-    updater.idle()
+    stop_services()
 
 
 if __name__ == '__main__':
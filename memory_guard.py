@@ -0,0 +1,221 @@
+"""Контроль памяти: RSS, снимки tracemalloc и сброс кешей при приближении к лимиту.
+
+Контейнер работает с жестким лимитом памяти (Amvera.yml), поэтому при
+превышении мягкого лимита бот сам освобождает кеши, не дожидаясь OOM.
+Отчет доступен на /debug/memory сервера метрик (METRICS_PORT, не вебхука).
+
+Чтобы tracemalloc видел и выделения при импорте модулей, запускайте с
+PYTHONTRACEMALLOC=<глубина стека>. Стоимость импорта зависимостей:
+    python memory_guard.py --imports telegram requests bs4
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+MB = 1024 * 1024
+
+# Служебные выделения, которые только засоряют отчет
+_IGNORED_TRACES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def read_rss():
+    """Текущий RSS процесса в байтах из /proc/self/statm (None вне Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class MemoryGuard:
+    """Периодически замеряет память и при превышении soft_limit сбрасывает кеши.
+
+    Сбрасыватели регистрируются через add_shedder: каждый освобождает
+    свою часть памяти и возвращает число удаленных записей (или None). При включенном
+    tracemalloc каждый замер сохраняет снимок и разницу с предыдущим.
+
+    После сброса защита взводится заново, только когда RSS опустится ниже
+    rearm_ratio * soft_limit, либо по истечении shed_cooldown секунд: иначе
+    процесс, чья рабочая память выше лимита, сбрасывал бы кеши (и пул
+    соединений CRM) на каждом замере.
+    """
+
+    def __init__(self, soft_limit=0, interval=30.0, trace_frames=0, top=10, rearm_ratio=0.9, shed_cooldown=600.0):
+        self.soft_limit = soft_limit
+        self.interval = interval
+        self.top = top
+        self.rearm_ratio = rearm_ratio
+        self.shed_cooldown = shed_cooldown
+
+        self._shedders = []
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._last = {}
+        self._stop = None
+        self._armed = True
+        self._last_shed = None
+        # RSS на момент создания, то есть после импорта всех модулей бота
+        self.startup_rss = read_rss()
+
+        if trace_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames)
+
+    def add_shedder(self, name, func):
+        self._shedders.append((name, func))
+
+    def shed(self):
+        """Сбрасывает все кеши; возвращает {имя: сколько удалено}"""
+        freed = {}
+        for name, func in self._shedders:
+            try:
+                freed[name] = func()
+            except Exception:
+                logger.exception("💥 Ошибка при сбросе кеша %s", name)
+        gc.collect()
+        return freed
+
+    def _take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED_TRACES)
+        previous, self._snapshot = self._snapshot, snapshot
+        top = snapshot.statistics('lineno')[:self.top]
+        diff = snapshot.compare_to(previous, 'lineno')[:self.top] if previous is not None else []
+        return [str(stat) for stat in top], [str(stat) for stat in diff]
+
+    def _may_shed(self):
+        if self._armed:
+            return True
+        return self._last_shed is None or time.monotonic() - self._last_shed >= self.shed_cooldown
+
+    def sample(self):
+        """Один замер: RSS, снимок tracemalloc и при необходимости сброс кешей"""
+        with self._lock:
+            rss = read_rss()
+            report = {'time': time.time(), 'rss': rss, 'soft_limit': self.soft_limit}
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                report['traced'] = current
+                report['traced_peak'] = peak
+                report['top'], report['diff'] = self._take_snapshot()
+
+            if self.soft_limit and rss is not None and rss < self.soft_limit * self.rearm_ratio:
+                self._armed = True
+            if self.soft_limit and rss is not None and rss > self.soft_limit and self._may_shed():
+                freed = self.shed()
+                self._armed = False
+                self._last_shed = time.monotonic()
+                metrics.MEMORY_SHEDS.inc()
+                report['shed'] = freed
+                report['rss_after_shed'] = read_rss()
+                logger.warning("🧹 RSS %.1f МБ выше мягкого лимита %.1f МБ, сброшены кеши: %s (стало %.1f МБ)",
+                               rss / MB, self.soft_limit / MB, freed, (report['rss_after_shed'] or 0) / MB)
+
+            self._last = report
+            return report
+
+    def render(self):
+        """Текстовый отчет о последнем замере.
+
+        Вызывается из потока HTTP-сервера, поэтому сам замер не делает:
+        иначе запрос к странице мог бы запустить сброс кешей.
+        """
+        report = self._last
+        if not report:
+            return f"Замеров еще не было (первый через {self.interval:.0f} с)\n"
+        lines = [
+            f"RSS: {(report['rss'] or 0) / MB:.1f} MB",
+            f"RSS после запуска: {(self.startup_rss or 0) / MB:.1f} MB",
+        ]
+        if report['soft_limit']:
+            lines.append(f"Мягкий лимит: {report['soft_limit'] / MB:.1f} MB")
+        if 'traced' in report:
+            lines.append(f"tracemalloc: {report['traced'] / MB:.1f} MB (пик {report['traced_peak'] / MB:.1f} MB)")
+            lines.append('')
+            lines.append('Крупнейшие выделения:')
+            lines.extend(report['top'])
+            if report['diff']:
+                lines.append('')
+                lines.append('Изменения с предыдущего замера:')
+                lines.extend(report['diff'])
+        else:
+            lines.append('tracemalloc выключен (MEMORY_TRACE_FRAMES или PYTHONTRACEMALLOC)')
+        if 'shed' in report:
+            lines.append('')
+            lines.append(f"Сброшены кеши: {report['shed']}")
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        self._stop = threading.Event()
+
+        def loop(stop):
+            while not stop.wait(self.interval):
+                try:
+                    self.sample()
+                except Exception:
+                    logger.exception("💥 Ошибка замера памяти")
+
+        threading.Thread(target=loop, args=(self._stop,), name='memory-guard', daemon=True).start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+_IMPORT_PROBE = '''
+import json, sys, time, tracemalloc
+from memory_guard import read_rss
+rss = read_rss()
+tracemalloc.start()
+started = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - started
+print(json.dumps({'ms': elapsed * 1000, 'traced': tracemalloc.get_traced_memory()[0], 'rss': read_rss() - rss}))
+'''
+
+
+def measure_imports(modules):
+    """Время и память импорта каждого модуля в отдельном чистом интерпретаторе"""
+    results = {}
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        output = subprocess.run(
+            [sys.executable, '-c', _IMPORT_PROBE, module], cwd=here, capture_output=True, text=True, check=True
+        ).stdout
+        results[module] = json.loads(output.splitlines()[-1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры памяти бота')
+    parser.add_argument('--imports', nargs='+', metavar='MODULE', help='измерить стоимость импорта модулей')
+    args = parser.parse_args()
+
+    if args.imports:
+        print(f"{'модуль':<12}{'время, мс':>12}{'tracemalloc, МБ':>18}{'RSS, МБ':>10}")
+        for module, cost in measure_imports(args.imports).items():
+            print(f"{module:<12}{cost['ms']:>12.1f}{cost['traced'] / MB:>18.1f}{cost['rss'] / MB:>10.1f}")
+    else:
+        guard = MemoryGuard()
+        guard.sample()
+        print(guard.render(), end='')
+
+
+if __name__ == '__main__':
+    main()
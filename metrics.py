@@ -0,0 +1,236 @@
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0)
+
+# Порядок шагов воронки опроса
+FUNNEL_STEPS = ('start', 'autostart', 'control', 'gps', 'phone')
+
+# Отладочные текстовые страницы сервера метрик (не вебхука): путь -> функция, возвращающая текст
+DEBUG_PAGES = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """Текущее значение; может вычисляться функцией collect в момент сбора метрик"""
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values = {}
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def render(self):
+        values = dict(self._values)
+        if self.collect is not None:
+            try:
+                collected = self.collect()
+            except Exception as e:
+                logger.warning("⚠️ Не удалось собрать метрику %s: %s", self.name, e)
+                collected = {}
+            values.update(collected if isinstance(collected, dict) else {(): collected})
+
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    label_text = _format_labels(self.labelnames, labels, ('le', _format_value(bound)))
+                    lines.append(f'{self.name}_bucket{label_text} {cumulative}')
+                label_text = _format_labels(self.labelnames, labels)
+                lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+                lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.register(Histogram(
+    'alarmbot_handler_duration_seconds', 'Время работы обработчика', ('handler',)))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'alarmbot_handler_errors_total', 'Исключения в обработчиках', ('handler',)))
+CRM_DURATION = REGISTRY.register(Histogram(
+    'alarmbot_crm_request_duration_seconds', 'Длительность запроса в CRM', ('outcome',)))
+CRM_REQUESTS = REGISTRY.register(Counter(
+    'alarmbot_crm_requests_total', 'Запросы в CRM по результату', ('outcome',)))
+FUNNEL = REGISTRY.register(Counter(
+    'alarmbot_funnel_total', 'Сколько раз пользователи дошли до шага опроса', ('step',)))
+FUNNEL_DROPOFF = REGISTRY.register(Gauge(
+    'alarmbot_funnel_dropoff', 'Сколько пользователей остановилось на шаге опроса', ('step',),
+    collect=lambda: {
+        (step,): max(0, FUNNEL.get(step) - FUNNEL.get(next_step))
+        for step, next_step in zip(FUNNEL_STEPS, FUNNEL_STEPS[1:])
+    }))
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    'alarmbot_active_sessions', 'Незавершенные опросы в хранилище сессий'))
+DUPLICATE_LEADS = REGISTRY.register(Counter(
+    'alarmbot_duplicate_leads_total', 'Повторные заявки, отвеченные без отправки в CRM'))
+CRM_CIRCUIT_STATE = REGISTRY.register(Gauge(
+    'alarmbot_crm_circuit_state', 'Состояние выключателя CRM (1 - текущее)', ('state',)))
+CRM_READ_TIMEOUT = REGISTRY.register(Gauge(
+    'alarmbot_crm_read_timeout_seconds', 'Текущий адаптивный таймаут чтения ответа CRM'))
+OUTBOX_PENDING = REGISTRY.register(Gauge(
+    'alarmbot_crm_outbox_pending', 'Заявки в очереди на отправку в CRM'))
+OUTBOX_FAILED = REGISTRY.register(Gauge(
+    'alarmbot_crm_outbox_failed', 'Заявки, не отправленные в CRM за все попытки (python crm_outbox.py --requeue)'))
+MEMORY_RSS = REGISTRY.register(Gauge(
+    'alarmbot_memory_rss_bytes', 'Резидентная память процесса'))
+MEMORY_SHEDS = REGISTRY.register(Counter(
+    'alarmbot_memory_sheds_total', 'Сбросы кешей из-за превышения мягкого лимита памяти'))
+
+
+def timed(handler_name):
+    """Декоратор: пишет время работы обработчика в гистограмму"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler_name)
+                raise
+            finally:
+                HANDLER_LATENCY.observe(time.perf_counter() - started, handler_name)
+        return wrapper
+    return decorator
+
+
+def funnel(step):
+    """Отмечает, что пользователь дошел до шага опроса"""
+    FUNNEL.inc(step)
+
+
+def observe_crm(duration, outcome):
+    CRM_DURATION.observe(duration, outcome)
+    CRM_REQUESTS.inc(outcome)
+
+
+class MetricsHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = REGISTRY.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path in DEBUG_PAGES:
+            body = DEBUG_PAGES[path]().encode('utf-8')
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, listen='0.0.0.0'):
+    """Отдает метрики в формате Prometheus на http://<listen>:<port>/metrics"""
+    httpd = ThreadingHTTPServer((listen, port), MetricsHTTPRequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info("📈 Метрики доступны на %s:%s/metrics", listen, port)
+    return httpd
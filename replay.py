@@ -0,0 +1,230 @@
+"""Запись обновлений и детерминированное воспроизведение с профилированием.
+
+Запись: задайте RECORD_PATH, и бот будет дописывать в файл входящие
+обновления Telegram и ответы CRM (одна компактная JSON-строка на событие,
+см. update_recorder.UpdateRecorder; телефоны заменяются псевдонимами).
+
+Воспроизведение через настоящие обработчики с заглушками вместо сети:
+    python replay.py recording.jsonl --json after.json --compare before.json
+    python replay.py recording.jsonl --profile replay.prof
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HANDLERS = ('start', 'autostart_choice', 'control_choice', 'gps_choice', 'get_phone')
+FAKE_TOKEN = '123456:REPLAY'
+
+
+def read_recording(path):
+    """Возвращает (список обновлений, список ответов CRM) из файла записи"""
+    updates, crm_responses = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['k'] == 'u':
+                updates.append(record['d'])
+            elif record['k'] == 'c':
+                crm_responses.append(record['s'])
+    return updates, crm_responses
+
+
+class HandlerStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.blocks = 0
+        self.traced_bytes = 0
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'total_ms': round(self.seconds * 1000, 3),
+            'mean_us': round(self.seconds / self.calls * 1e6, 1) if self.calls else 0.0,
+            'alloc_blocks': self.blocks,
+            'traced_bytes': self.traced_bytes,
+        }
+
+
+def profiled(name, func, stats):
+    """Оборачивает обработчик: время, прирост выделенных блоков и (при tracemalloc) байт"""
+    def wrapper(*args, **kwargs):
+        entry = stats.setdefault(name, HandlerStats())
+        blocks = sys.getallocatedblocks()
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            entry.seconds += time.perf_counter() - started
+            entry.calls += 1
+            entry.blocks += sys.getallocatedblocks() - blocks
+            if tracemalloc.is_tracing():
+                entry.traced_bytes += tracemalloc.get_traced_memory()[0] - traced
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def _prepare_environment():
+    workdir = tempfile.mkdtemp(prefix='alarmbot-replay-')
+    os.environ.update({
+        'BOT_TOKEN': FAKE_TOKEN,
+        'CRM_OUTBOX_PATH': os.path.join(workdir, 'outbox.db'),
+        'LOG_LEVEL': os.getenv('REPLAY_LOG_LEVEL', 'WARNING'),
+    })
+    for name in ('SESSION_DB_PATH', 'RECORD_PATH', 'LEAD_DEDUP_PATH', 'CATALOG_PATH'):
+        os.environ.pop(name, None)
+
+
+def run(path, profile_path=None, trace_allocations=False):
+    _prepare_environment()
+
+    from datetime import datetime
+    from queue import Queue
+
+    from telegram import Bot, Chat, Message, Update, User
+    from telegram.ext import Dispatcher, JobQueue
+
+    import crm_transport
+    import main
+    from circuit_breaker import CircuitOpenError
+
+    main.setup_logging()
+    main.setup()
+    updates, crm_responses = read_recording(path)
+
+    class ReplayBot(Bot):
+        """Bot без сети: ответы обработчиков сразу превращаются в Message"""
+
+        def __init__(self, token):
+            super().__init__(token)
+            # Без этого CommandHandler запросил бы getMe ради имени бота
+            self._bot = User(int(token.split(':')[0]), 'Replay', True, username='replay_bot')
+            self._sent = 0
+
+        def send_message(self, chat_id, text, *args, **kwargs):
+            self._sent += 1
+            return Message(self._sent, datetime.now(), Chat(chat_id, Chat.PRIVATE), text=text, bot=self)
+
+        def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+            return Message(message_id or 0, datetime.now(), Chat(chat_id, Chat.PRIVATE), text=text, bot=self)
+
+    class ReplayResponse:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.text = ''
+
+    responses = iter(crm_responses)
+
+    def replay_post(url, **kwargs):
+        status = next(responses, 200)
+        if status is None:
+            raise ConnectionError('recorded CRM failure')
+        return ReplayResponse(status)
+
+    crm_transport.post = replay_post
+
+    # Заявки не ставим в фоновую очередь, а отправляем после прогона синхронно
+    leads = []
+
+    class ReplayOutbox:
+        def enqueue(self, phone_number, user_name=None, user_id=None):
+            leads.append((phone_number, user_name))
+            return len(leads)
+
+    main.crm_outbox = ReplayOutbox()
+
+    stats = {}
+    for name in HANDLERS:
+        setattr(main, name, profiled(name, getattr(main, name), stats))
+    send_to_crm = profiled('send_to_crm', main.send_to_crm, stats)
+
+    bot = ReplayBot(FAKE_TOKEN)
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, Queue(), workers=1, job_queue=job_queue, use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    dispatcher.add_handler(main.build_conversation_handler())
+    parsed = [Update.de_json(data, bot) for data in updates]
+
+    if trace_allocations:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile_path else None
+
+    rejected = 0
+    started = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    for update in parsed:
+        dispatcher.process_update(update)
+    for phone_number, user_name in leads:
+        try:
+            send_to_crm(phone_number, user_name)
+        except CircuitOpenError:
+            # В бою очередь отложила бы заявку - здесь просто считаем такие случаи
+            rejected += 1
+    if profiler:
+        profiler.disable()
+    elapsed = time.perf_counter() - started
+
+    if trace_allocations:
+        tracemalloc.stop()
+    if profiler:
+        profiler.dump_stats(profile_path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+    return {
+        'recording': os.path.basename(path),
+        'updates': len(parsed),
+        'leads': len(leads),
+        'messages_sent': bot._sent,
+        'crm_rejected': rejected,
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'updates_per_s': round(len(parsed) / elapsed, 1) if elapsed else 0.0,
+        'handlers': {name: entry.as_dict() for name, entry in sorted(stats.items())},
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"Обновлений: {report['updates']}, заявок: {report['leads']}, "
+          f"время: {report['elapsed_ms']} мс ({report['updates_per_s']} обновлений/с)")
+    print(f"{'обработчик':<18}{'вызовов':>9}{'всего, мс':>12}{'среднее, мкс':>14}{'блоков':>10}{'байт':>12}")
+    for name, entry in report['handlers'].items():
+        line = (f"{name:<18}{entry['calls']:>9}{entry['total_ms']:>12}{entry['mean_us']:>14}"
+                f"{entry['alloc_blocks']:>10}{entry['traced_bytes']:>12}")
+        if baseline and name in baseline.get('handlers', {}):
+            before = baseline['handlers'][name]['mean_us']
+            if before:
+                line += f"  {(entry['mean_us'] - before) / before * 100:+.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных обновлений с профилированием')
+    parser.add_argument('recording', help='файл, записанный с RECORD_PATH')
+    parser.add_argument('--profile', help='сохранить статистику cProfile в файл')
+    parser.add_argument('--tracemalloc', action='store_true', help='считать выделенную память по обработчикам')
+    parser.add_argument('--json', dest='json_path', help='сохранить отчет в JSON')
+    parser.add_argument('--compare', help='JSON-отчет предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    report = run(args.recording, args.profile, args.tracemalloc)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import html
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений (меньше - важнее)
+CONFIRMATION, NORMAL, NOTICE = range(3)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def penalize(self, seconds):
+        """Блокирует ведро на seconds секунд (например, после ответа 429)"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('kind', 'chat_id', 'text', 'kwargs', 'priority', 'seq', 'enqueued_at', 'futures', 'target')
+
+    def __init__(self, kind, chat_id, text, kwargs, priority, seq, target=None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.futures = [Future()]
+        self.target = target
+
+
+def _merge(first, second):
+    """Склеивает два соседних сообщения одного чата или возвращает None, если нельзя"""
+    if first.kind != 'send' or second.kind != 'send':
+        return None
+
+    first_mode = first.kwargs.get('parse_mode')
+    second_mode = second.kwargs.get('parse_mode')
+    first_text, second_text = first.text, second.text
+    if first_mode != second_mode:
+        # Разметку умеем сводить только к HTML
+        if {first_mode, second_mode} != {None, 'HTML'}:
+            return None
+        if first_mode is None:
+            first_text = html.escape(first_text)
+        else:
+            second_text = html.escape(second_text)
+
+    text = f"{first_text}\n\n{second_text}"
+    if len(text) > MAX_MESSAGE_LENGTH:
+        return None
+
+    kwargs = dict(first.kwargs)
+    kwargs.update(second.kwargs)
+    if first_mode or second_mode:
+        kwargs['parse_mode'] = first_mode or second_mode
+    if first.kwargs.get('disable_web_page_preview') or second.kwargs.get('disable_web_page_preview'):
+        kwargs['disable_web_page_preview'] = True
+    # Клавиатура действует от последнего сообщения, поэтому берем последнюю заданную
+    markup = second.kwargs.get('reply_markup') or first.kwargs.get('reply_markup')
+    if markup is not None:
+        kwargs['reply_markup'] = markup
+
+    merged = _Job('send', first.chat_id, text, kwargs, min(first.priority, second.priority), first.seq)
+    merged.enqueued_at = first.enqueued_at
+    merged.futures = first.futures + second.futures
+    return merged
+
+
+class SendScheduler:
+    """Планировщик исходящих сообщений с учетом флуд-лимитов Telegram.
+
+    Глобальное и почтовое (на чат) ведра токенов ограничивают частоту
+    отправки, между чатами первым уходит более приоритетное сообщение,
+    внутри чата порядок сохраняется. Соседние сообщения одного чата,
+    накопившиеся в очереди, склеиваются в одно.
+    """
+
+    def __init__(self, bot, global_rate=30.0, chat_rate=1.0, chat_burst=3, linger=0.02, workers=4):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.linger = linger
+        self.workers = workers
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._buckets = {}
+        self._busy = set()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def send(self, chat_id, text, priority=NORMAL, **kwargs):
+        """Ставит сообщение в очередь; возвращает Future с отправленным Message"""
+        return self._enqueue('send', chat_id, text, kwargs, priority)
+
+    def edit(self, message_future, text, priority=NORMAL, **kwargs):
+        """Меняет текст ранее поставленного сообщения.
+
+        Если сообщение еще не ушло, текст заменяется прямо в очереди и
+        лишнего запроса к Bot API не будет.
+        """
+        with self._cond:
+            for queue in self._chats.values():
+                for job in queue:
+                    if job.kind == 'send' and message_future in job.futures and len(job.futures) == 1:
+                        job.text = text
+                        job.kwargs.update(kwargs)
+                        return message_future
+
+        chat_id = message_future.result().chat_id
+        return self._enqueue('edit', chat_id, text, kwargs, priority, target=message_future)
+
+    def pending(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._chats.values())
+
+    def _enqueue(self, kind, chat_id, text, kwargs, priority, target=None):
+        with self._cond:
+            self._seq += 1
+            job = _Job(kind, chat_id, text, kwargs, priority, self._seq, target)
+            self._chats.setdefault(chat_id, deque()).append(job)
+            self._cond.notify()
+            return job.futures[0]
+
+    def start(self):
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'send-scheduler-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Отправляет все, что осталось в очереди, и останавливает потоки"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _pick(self, now):
+        """Выбирает чат для отправки; возвращает (chat_id, задержка до следующей попытки)"""
+        best = None
+        wait = None
+        for chat_id, queue in self._chats.items():
+            if chat_id in self._busy or not queue:
+                continue
+            head = queue[0]
+            ready_in = max(head.enqueued_at + self.linger - now, self._bucket(chat_id).delay(now))
+            if ready_in > 0:
+                wait = ready_in if wait is None else min(wait, ready_in)
+                continue
+            if best is None or (head.priority, head.seq) < best[0]:
+                best = ((head.priority, head.seq), chat_id)
+
+        if best is None:
+            return None, wait
+
+        global_wait = self._global.delay(now)
+        if global_wait > 0:
+            return None, global_wait
+        return best[1], None
+
+    def _take(self, chat_id, now):
+        """Снимает голову очереди чата, склеивая с ней следующие сообщения"""
+        queue = self._chats[chat_id]
+        job = queue.popleft()
+        while queue:
+            merged = _merge(job, queue[0])
+            if merged is None:
+                break
+            queue.popleft()
+            job = merged
+
+        self._bucket(chat_id).consume(now)
+        self._global.consume(now)
+        self._busy.add(chat_id)
+        return job
+
+    def _release(self, chat_id, now):
+        self._busy.discard(chat_id)
+        if not self._chats.get(chat_id):
+            self._chats.pop(chat_id, None)
+        # Не даем словарю ведер расти бесконечно: убираем ведра простаивающих чатов
+        if len(self._buckets) > 10000:
+            for idle_chat in [c for c, b in self._buckets.items() if c not in self._chats and b.is_full(now)]:
+                del self._buckets[idle_chat]
+        self._cond.notify_all()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    chat_id, wait = self._pick(now)
+                    if chat_id is not None:
+                        job = self._take(chat_id, now)
+                        break
+                    if self._stopping and not self._chats:
+                        return
+                    self._cond.wait(wait)
+
+            try:
+                self._perform(job)
+            except RetryAfter as e:
+                logger.warning("⚠️ Флуд-лимит Telegram для чата %s, пауза %s с", job.chat_id, e.retry_after)
+                with self._cond:
+                    self._bucket(job.chat_id).penalize(e.retry_after)
+                    self._chats.setdefault(job.chat_id, deque()).appendleft(job)
+            except Exception as e:
+                logger.error("❌ Не удалось отправить сообщение в чат %s: %s", job.chat_id, e)
+                for future in job.futures:
+                    future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._release(job.chat_id, time.monotonic())
+
+    def _perform(self, job):
+        if job.kind == 'edit':
+            target = job.target.result()
+            result = self.bot.edit_message_text(
+                job.text, chat_id=job.chat_id, message_id=target.message_id, **job.kwargs
+            )
+        else:
+            result = self.bot.send_message(job.chat_id, job.text, **job.kwargs)
+        for future in job.futures:
+            future.set_result(result)
@@ -0,0 +1,204 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Коды ответов для упаковки в одно целое (2 бита на ответ)
+_UNSET = 3
+_CONTROL_CODES = {'remote': 0, 'app': 1}
+_CONTROL_NAMES = {code: name for name, code in _CONTROL_CODES.items()}
+
+
+class Session:
+    """Компактная запись ответов пользователя в опросе"""
+
+    __slots__ = ('autostart', 'control', 'gps', 'updated_at')
+
+    def __init__(self, autostart=None, control=None, gps=None, updated_at=0.0):
+        self.autostart = autostart
+        self.control = control
+        self.gps = gps
+        self.updated_at = updated_at
+
+    def pack(self):
+        """Упаковывает три ответа в одно целое"""
+        autostart = _UNSET if self.autostart is None else self.autostart
+        control = _UNSET if self.control is None else _CONTROL_CODES[self.control]
+        gps = _UNSET if self.gps is None else self.gps
+        return autostart | (control << 2) | (gps << 4)
+
+    @classmethod
+    def unpack(cls, packed, updated_at=0.0):
+        autostart = packed & 3
+        control = (packed >> 2) & 3
+        gps = (packed >> 4) & 3
+        return cls(
+            None if autostart == _UNSET else autostart,
+            _CONTROL_NAMES.get(control),
+            None if gps == _UNSET else gps,
+            updated_at
+        )
+
+    def __repr__(self):
+        return f"Session(autostart={self.autostart!r}, control={self.control!r}, gps={self.gps!r})"
+
+
+class SqliteSessionBackend:
+    """Хранение сессий на диске, чтобы незавершенные опросы пережили передеплой"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        # WAL позволяет нескольким процессам бота работать с одной базой
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            ' user_id INTEGER PRIMARY KEY,'
+            ' packed INTEGER NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        )
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT packed, updated_at FROM sessions WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Session.unpack(row[0], row[1])
+
+    def save(self, user_id, session):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sessions (user_id, packed, updated_at) VALUES (?, ?, ?)',
+                (user_id, session.pack(), session.updated_at)
+            )
+
+    def delete(self, user_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+    def count(self, newer_than):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM sessions WHERE updated_at >= ?', (newer_than,)).fetchone()[0]
+
+    def purge(self, older_than):
+        with self._lock:
+            return self._conn.execute('DELETE FROM sessions WHERE updated_at < ?', (older_than,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SessionStore:
+    """Ограниченное хранилище сессий опроса с TTL и вытеснением по LRU.
+
+    В памяти хранится не больше max_size сессий; сессии, которые не
+    обновлялись дольше ttl секунд, удаляются. При наличии backend
+    сессии дублируются на диск и подгружаются оттуда при промахе.
+    """
+
+    def __init__(self, max_size=10000, ttl=86400.0, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def active_count(self):
+        """Число незавершенных сессий; при наличии backend - по общему хранилищу, а не по кешу в памяти"""
+        if self.backend is not None:
+            return self.backend.count(time.time() - self.ttl)
+        return len(self._sessions)
+
+    def _expired(self, session, now):
+        return now - session.updated_at > self.ttl
+
+    def get(self, user_id):
+        """Возвращает сессию пользователя или None, если ее нет или она устарела"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                if self._expired(session, now):
+                    del self._sessions[user_id]
+                    session = None
+                else:
+                    self._sessions.move_to_end(user_id)
+                    return session
+
+        if self.backend is None:
+            return None
+
+        session = self.backend.load(user_id)
+        if session is None:
+            return None
+        if self._expired(session, now):
+            self.backend.delete(user_id)
+            return None
+        with self._lock:
+            self._put(user_id, session)
+        return session
+
+    def update(self, user_id, **answers):
+        """Записывает ответы в сессию (создавая ее при необходимости) и возвращает ее"""
+        session = self.get(user_id) or Session()
+        for name, value in answers.items():
+            setattr(session, name, value)
+        session.updated_at = time.time()
+
+        with self._lock:
+            self._put(user_id, session)
+        if self.backend is not None:
+            self.backend.save(user_id, session)
+        return session
+
+    def reset(self, user_id, **answers):
+        """Начинает новую сессию с нуля"""
+        self.delete(user_id)
+        return self.update(user_id, **answers)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+        if self.backend is not None:
+            self.backend.delete(user_id)
+
+    def purge_expired(self):
+        """Удаляет все устаревшие сессии и возвращает их количество"""
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, session in self._sessions.items() if self._expired(session, now)]
+            for user_id in expired:
+                del self._sessions[user_id]
+        purged = len(expired)
+        if self.backend is not None:
+            purged = max(purged, self.backend.purge(now - self.ttl))
+        return purged
+
+    def evict_idle(self, max_idle):
+        """Выгружает из памяти сессии, не обновлявшиеся дольше max_idle секунд, и возвращает их количество.
+
+        Сессии с backend остаются на диске и подгрузятся при следующем обращении.
+        """
+        cutoff = time.time() - max_idle
+        with self._lock:
+            idle = [user_id for user_id, session in self._sessions.items() if session.updated_at < cutoff]
+            for user_id in idle:
+                del self._sessions[user_id]
+        return len(idle)
+
+    def _put(self, user_id, session):
+        # Вызывается под блокировкой
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
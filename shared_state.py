@@ -0,0 +1,213 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+
+def connect_shared(path):
+    """Соединение с SQLite, пригодное для совместной работы нескольких процессов"""
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class ConversationStore(ABC):
+    """Интерфейс хранилища состояний диалогов.
+
+    Реализация для сетевого хранилища (например, Redis) должна
+    предоставить те же методы; ключ - строка, состояние - int.
+    Каждая запись помнит время последнего изменения: таймеры диалогов
+    не переживают перезапуск, поэтому брошенные диалоги удаляет
+    purge_expired.
+    """
+
+    @abstractmethod
+    def get_state(self, name, key):
+        pass
+
+    @abstractmethod
+    def set_state(self, name, key, state):
+        pass
+
+    @abstractmethod
+    def delete_state(self, name, key):
+        pass
+
+    @abstractmethod
+    def list_keys(self, name):
+        pass
+
+    @abstractmethod
+    def purge_expired(self, name, older_than):
+        """Удаляет состояния, не менявшиеся с older_than (unix time), и возвращает их количество"""
+
+
+class SqliteConversationStore(ConversationStore):
+    """Состояния диалогов в SQLite (WAL): любой процесс видит изменения остальных сразу"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = connect_shared(path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS conversations ('
+            ' name TEXT NOT NULL,'
+            ' conv_key TEXT NOT NULL,'
+            ' state INTEGER NOT NULL,'
+            ' updated_at REAL,'
+            ' PRIMARY KEY (name, conv_key))'
+        )
+        # Базы, созданные до появления updated_at: старые диалоги получают полный срок с этого момента
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(conversations)')]
+        if 'updated_at' not in columns:
+            self._conn.execute('ALTER TABLE conversations ADD COLUMN updated_at REAL')
+        self._conn.execute('UPDATE conversations SET updated_at = ? WHERE updated_at IS NULL', (time.time(),))
+
+    def get_state(self, name, key):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT state FROM conversations WHERE name = ? AND conv_key = ?', (name, key)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, name, key, state):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO conversations (name, conv_key, state, updated_at) VALUES (?, ?, ?, ?)',
+                (name, key, state, time.time())
+            )
+
+    def delete_state(self, name, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM conversations WHERE name = ? AND conv_key = ?', (name, key))
+
+    def list_keys(self, name):
+        with self._lock:
+            rows = self._conn.execute('SELECT conv_key FROM conversations WHERE name = ?', (name,)).fetchall()
+        return [row[0] for row in rows]
+
+    def purge_expired(self, name, older_than):
+        with self._lock:
+            return self._conn.execute(
+                'DELETE FROM conversations WHERE name = ? AND updated_at < ?', (name, older_than)
+            ).rowcount
+
+
+class MemoryConversations(MutableMapping):
+    """Состояния ConversationHandler в памяти процесса со временем последнего изменения.
+
+    Заменяет conversation_timeout: вместо задачи планировщика на каждое
+    обновление брошенные диалоги периодически удаляет purge_expired.
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def __getitem__(self, key):
+        return self._states[key][0]
+
+    def __setitem__(self, key, state):
+        self._states[key] = (state, time.time())
+
+    def __delitem__(self, key):
+        del self._states[key]
+
+    def __iter__(self):
+        return iter(list(self._states))
+
+    def __len__(self):
+        return len(self._states)
+
+    def purge_expired(self, older_than):
+        """Завершает диалоги, не продвигавшиеся с older_than; возвращает их количество"""
+        expired = [key for key, (_, updated_at) in list(self._states.items()) if updated_at < older_than]
+        for key in expired:
+            self._states.pop(key, None)
+        return len(expired)
+
+
+class StoredConversations(MutableMapping):
+    """Словарь состояний ConversationHandler, который читает и пишет прямо в хранилище"""
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    @staticmethod
+    def _encode(key):
+        return json.dumps(list(key))
+
+    @staticmethod
+    def _decode(key):
+        return tuple(json.loads(key))
+
+    def __getitem__(self, key):
+        state = self.store.get_state(self.name, self._encode(key))
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        if not isinstance(state, int):
+            # Отложенные состояния (run_async) не переживают процесс - храним только итоговые
+            logger.debug("Пропускаем не целое состояние диалога %s: %r", key, state)
+            return
+        self.store.set_state(self.name, self._encode(key), state)
+
+    def __delitem__(self, key):
+        self.store.delete_state(self.name, self._encode(key))
+
+    def __iter__(self):
+        return (self._decode(key) for key in self.store.list_keys(self.name))
+
+    def __len__(self):
+        return len(self.store.list_keys(self.name))
+
+    def purge_expired(self, older_than):
+        """Завершает диалоги, не продвигавшиеся с older_than; возвращает их количество"""
+        return self.store.purge_expired(self.name, older_than)
+
+
+class SharedPersistence(BasePersistence):
+    """Persistence для PTB, хранящий только состояния диалогов во внешнем хранилище.
+
+    Ответы опроса хранятся отдельно в SessionStore, поэтому user/chat/bot
+    data не сохраняются.
+    """
+
+    def __init__(self, store):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self.store = store
+
+    def get_conversations(self, name):
+        return StoredConversations(self.store, name)
+
+    def update_conversation(self, name, key, new_state):
+        # StoredConversations уже записал изменение в хранилище
+        pass
+
+    def get_user_data(self):
+        return {}
+
+    def get_chat_data(self):
+        return {}
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,43 @@
+from telegram import Update
+from telegram.ext import Handler
+
+
+class ButtonHandler(Handler):
+    """Обработчик кнопок одного состояния опроса: проверка - один поиск в словаре маршрутов"""
+
+    __slots__ = ('routes', 'state')
+
+    def __init__(self, routes, state):
+        super().__init__(callback=None)
+        self.routes = routes
+        self.state = state
+
+    def check_update(self, update):
+        if isinstance(update, Update) and update.message is not None and update.message.text is not None:
+            return self.routes.get((self.state, update.message.text))
+        return None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        callback, answer = check_result
+        return callback(update, context, answer)
+
+
+class SurveyRouter:
+    """Таблица (состояние, точный текст кнопки) -> (обработчик, расшифрованный ответ).
+
+    Заменяет Filters.regex для кнопок опроса: вместо регулярного выражения
+    на каждое обновление и повторного разбора текста в обработчике
+    выполняется одно обращение к словарю, а обработчик получает готовое
+    значение ответа третьим аргументом.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def add_buttons(self, state, buttons, callback):
+        """buttons - словарь {текст кнопки: значение ответа}"""
+        for text, answer in buttons.items():
+            self.routes[(state, text)] = (callback, answer)
+
+    def handler(self, state):
+        return ButtonHandler(self.routes, state)
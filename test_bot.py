@@ -0,0 +1,1090 @@
+import io
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+import urllib.error
+import urllib.request
+
+from telegram import Update
+from telegram.ext import Dispatcher, Filters, MessageHandler, TypeHandler, Updater
+from telegram.utils.deprecate import TelegramDeprecationWarning
+
+import catalog
+import chat_executor
+import log_setup
+import send_scheduler
+import webhook_server
+from catalog_sync import CatalogSync, parse_product_page
+from chat_executor import ChatOrderedExecutor
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from crm_outbox import CrmOutbox
+from fake_servers import FakeFormServer, FakeShopServer, FakeTelegramServer
+from form_handler import SimpleFormHandler
+from lead_dedup import LeadDeduplicator
+from main import PRODUCTS_DATA
+from memory_guard import MemoryGuard
+from session_store import Session
+from shared_state import MemoryConversations, SqliteConversationStore, StoredConversations
+from survey_router import SurveyRouter
+from update_recorder import UpdateRecorder
+
+FAKE_TOKEN = '123456:TEST'
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def http_request(url, body=None, headers=None):
+    """Возвращает (статус, тело) без исключения на 4xx/5xx"""
+    request = urllib.request.Request(url, data=body, headers=headers or {}, method='POST' if body is not None else 'GET')
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return True
+        except OSError:
+            # Сервер еще не начал слушать порт
+            pass
+        time.sleep(0.02)
+    return False
+
+
+def make_update(update_id, chat_id, text):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    }).encode()
+
+
+class WebhookServerTest(unittest.TestCase):
+    def setUp(self):
+        self.updates = queue.Queue()
+        self.server = webhook_server.WebhookServer(None, self.updates, listen='127.0.0.1', port=0,
+                                                   url_path='hook', secret_token='s3cret')
+        self.server.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.stop()
+
+    def post(self, body, secret='s3cret'):
+        headers = {webhook_server.SECRET_HEADER: secret} if secret else {}
+        return http_request(self.url + '/hook', body, headers)[0]
+
+    def test_valid_update_is_queued(self):
+        self.assertEqual(self.post(make_update(1, 42, 'hi')), 200)
+        self.assertEqual(self.updates.get(timeout=1).message.text, 'hi')
+
+    def test_wrong_secret_is_rejected(self):
+        self.assertEqual(self.post(make_update(1, 42, 'hi'), secret='nope'), 403)
+        self.assertEqual(self.post(make_update(1, 42, 'hi'), secret=None), 403)
+        # Не-ASCII в заголовке: ответ 403, а не оборванное соединение
+        self.assertEqual(self.post(make_update(1, 42, 'hi'), secret='sécret'), 403)
+        self.assertTrue(self.updates.empty())
+
+    def test_malformed_bodies_get_400(self):
+        bodies = [b'not json', b'[1, 2]', b'"text"', b'{"message": {}}',
+                  b'{"update_id": 1, "message": {"message_id": 1}}']
+        for body in bodies:
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body), 400)
+        self.assertTrue(self.updates.empty())
+        # Соединение не обрывается: сервер продолжает отвечать
+        self.assertEqual(self.post(make_update(2, 42, 'still alive')), 200)
+
+    def test_health_and_readiness(self):
+        self.assertEqual(http_request(self.url + '/healthz')[0], 200)
+        self.assertEqual(http_request(self.url + '/readyz')[0], 503)
+        self.server.ready.set()
+        self.assertEqual(http_request(self.url + '/readyz')[0], 200)
+
+    def test_metrics_are_not_served(self):
+        self.assertEqual(http_request(self.url + '/metrics')[0], 404)
+
+    def test_debug_pages_are_not_served(self):
+        import metrics
+        metrics.DEBUG_PAGES['/debug/test'] = lambda: 'secret'
+        try:
+            self.assertEqual(http_request(self.url + '/debug/test')[0], 404)
+        finally:
+            del metrics.DEBUG_PAGES['/debug/test']
+
+
+class RunWebhookTest(unittest.TestCase):
+    """run_webhook против заглушки Bot API: setWebhook, прием обновления и ответ бота"""
+
+    def setUp(self):
+        self.telegram = FakeTelegramServer().start()
+        self.updater = Updater(FAKE_TOKEN, base_url=f"{self.telegram.url}/bot", use_context=True)
+        self.updater.dispatcher.add_handler(MessageHandler(
+            Filters.text, lambda update, context: update.message.reply_text('pong: ' + update.message.text)
+        ))
+        self.handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        self.telegram.stop()
+
+    def test_update_round_trip(self):
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        result = {}
+
+        def client():
+            try:
+                result['ready'] = wait_for(lambda: http_request(url + '/readyz')[0] == 200)
+                result['status'] = http_request(url + '/telegram', make_update(1, 42, 'ping'))[0]
+                result['replied'] = wait_for(lambda: self.telegram.sent)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Thread(target=client, daemon=True).start()
+        webhook_server.run_webhook(self.updater, 'https://bot.example.com', listen='127.0.0.1', port=port)
+
+        self.assertNotIn('error', result)
+        self.assertTrue(result['ready'])
+        self.assertEqual(result['status'], 200)
+        self.assertTrue(result['replied'])
+        method, chat_id, params = self.telegram.sent[0]
+        self.assertEqual((method, chat_id, params['text']), ('sendMessage', 42, 'pong: ping'))
+
+
+class ParseProductPageTest(unittest.TestCase):
+    def test_table_with_itemprop_price(self):
+        self.assertEqual(parse_product_page(read_fixture('pandora-vx-4g-gps-v2.html')), {
+            'name': 'Pandora VX-4G GPS v2', 'price': 32990,
+            'autostart': 1, 'remote': 0, 'gsm': 1, 'gps': 1,
+        })
+
+    def test_list_with_og_title_and_price_class(self):
+        self.assertEqual(parse_product_page(read_fixture('starline-a93-v2-eco.html')), {
+            'name': 'StarLine А93 v2 ECO', 'price': 15400,
+            'autostart': 1, 'remote': 1, 'gsm': 0, 'gps': 0,
+        })
+
+    def test_unknown_page_gives_nothing(self):
+        self.assertEqual(parse_product_page('<html><body><p>Страница не найдена</p></body></html>'), {})
+
+
+class CatalogSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.shop = FakeShopServer({
+            '/pandora/': read_fixture('pandora-vx-4g-gps-v2.html'),
+            '/starline/': read_fixture('starline-a93-v2-eco.html'),
+        }).start()
+        self.directory = tempfile.TemporaryDirectory()
+        self.catalog_path = os.path.join(self.directory.name, 'catalog.json')
+        self.seed = [
+            {'name': 'Pandora', 'autostart': 0, 'remote': 0, 'gsm': 0, 'gps': 0, 'link': self.shop.link('/pandora/')},
+            {'name': 'StarLine', 'autostart': 0, 'remote': 0, 'gsm': 0, 'gps': 0, 'link': self.shop.link('/starline/')},
+        ]
+        self.updates = []
+
+    def tearDown(self):
+        self.shop.stop()
+        self.directory.cleanup()
+
+    def make_sync(self):
+        return CatalogSync(self.catalog_path, self.seed, workers=2, on_update=self.updates.append)
+
+    def load_catalog(self):
+        with open(self.catalog_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def test_first_run_fills_catalog(self):
+        self.assertEqual(self.make_sync().run_once(), 2)
+        products = self.load_catalog()
+        self.assertEqual([product['name'] for product in products], ['Pandora VX-4G GPS v2', 'StarLine А93 v2 ECO'])
+        self.assertEqual(products[0]['link'], self.shop.link('/pandora/'))
+        self.assertEqual(len(self.updates), 1)
+
+    def test_unchanged_pages_answer_304(self):
+        self.make_sync().run_once()
+        before = self.load_catalog()
+        self.shop.requests.clear()
+
+        # Новый экземпляр: валидаторы должны читаться с диска, как после перезапуска
+        self.assertEqual(self.make_sync().run_once(), 0)
+        self.assertEqual(sorted(status for _, status in self.shop.requests), [304, 304])
+        self.assertEqual(self.load_catalog(), before)
+        self.assertEqual(len(self.updates), 1)
+
+    def test_changed_page_is_downloaded_again(self):
+        self.make_sync().run_once()
+        self.shop.pages['/starline/'] = self.shop.pages['/starline/'].replace('15 400', '14 900')
+        self.shop.requests.clear()
+
+        self.assertEqual(self.make_sync().run_once(), 1)
+        self.assertEqual(dict(self.shop.requests), {'/pandora/': 304, '/starline/': 200})
+        self.assertEqual(self.load_catalog()[1]['price'], 14900)
+
+    def test_failed_page_keeps_previous_data(self):
+        self.make_sync().run_once()
+        del self.shop.pages['/pandora/']
+        self.assertEqual(self.make_sync().run_once(), 0)
+        self.assertEqual(self.load_catalog()[0]['name'], 'Pandora VX-4G GPS v2')
+
+
+class CatalogReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'catalog.json')
+        self.default = [{'name': 'Default', 'link': 'https://example.com/default/'}]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, data):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+    def test_valid_file_replaces_default(self):
+        self.write([{'name': 'From file', 'link': 'https://example.com/file/', 'gps': 1}])
+        products = catalog.Catalog(self.default, path=self.path).index.products
+        self.assertEqual([product['name'] for product in products], ['From file'])
+
+    def test_malformed_file_keeps_previous_catalog(self):
+        for data in ({'name': 'object, not list'}, [1, 2], [{'name': 'no link'}], 'text'):
+            with self.subTest(data=data):
+                self.write(data)
+                loaded = catalog.Catalog(self.default, path=self.path)
+                self.assertEqual(loaded.index.products, self.default)
+                self.assertFalse(loaded.maybe_reload(force=True))
+
+    def test_broken_file_after_good_one(self):
+        self.write([{'name': 'Good', 'link': 'https://example.com/good/'}])
+        loaded = catalog.Catalog(self.default, path=self.path)
+        self.write({'products': []})
+        os.utime(self.path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+        self.assertFalse(loaded.maybe_reload(force=True))
+        self.assertEqual(loaded.index.products[0]['name'], 'Good')
+
+
+def legacy_recommend(products, autostart, control, gps):
+    """Прежний линейный подбор из обработчика gps_choice"""
+    recommended = []
+    for product in products:
+        if autostart == 1 and product['autostart'] == 0:
+            continue
+        if control == 'app' and product['gsm'] == 0:
+            continue
+        if gps == 1 and product['gps'] == 0:
+            continue
+        recommended.append(product)
+        if len(recommended) == 2:
+            break
+    return recommended
+
+
+class RecommendationIndexTest(unittest.TestCase):
+    def test_matches_legacy_filter(self):
+        index = catalog.RecommendationIndex(PRODUCTS_DATA)
+        for autostart, control, gps in itertools.product((0, 1), ('app', 'remote'), (0, 1)):
+            with self.subTest(autostart=autostart, control=control, gps=gps):
+                required = catalog.required_mask(autostart, control, gps)
+                self.assertEqual(list(index.recommend(required)),
+                                 legacy_recommend(PRODUCTS_DATA, autostart, control, gps))
+
+    def test_required_mask(self):
+        self.assertEqual(catalog.required_mask(0, 'remote', 0), 0)
+        self.assertEqual(catalog.required_mask(1, 'app', 1),
+                         catalog.FEATURE_AUTOSTART | catalog.FEATURE_GSM | catalog.FEATURE_GPS)
+        self.assertEqual(catalog.required_mask(0, 'remote', 1), catalog.FEATURE_GPS)
+
+    def test_priority_wins_over_catalog_order(self):
+        products = [dict(PRODUCTS_DATA[0], priority=0), dict(PRODUCTS_DATA[1], priority=5)]
+        self.assertEqual(catalog.RecommendationIndex(products).recommend(0)[0]['name'], PRODUCTS_DATA[1]['name'])
+
+    def test_nothing_found_message(self):
+        index = catalog.RecommendationIndex([])
+        self.assertEqual(index.message(catalog.FEATURE_GPS), catalog.NOTHING_FOUND_TEXT)
+
+
+class SessionPackTest(unittest.TestCase):
+    def test_round_trip(self):
+        for answers in itertools.product((None, 0, 1), (None, 'app', 'remote'), (None, 0, 1)):
+            with self.subTest(answers=answers):
+                restored = Session.unpack(Session(*answers).pack(), updated_at=12.5)
+                self.assertEqual((restored.autostart, restored.control, restored.gps), answers)
+                self.assertEqual(restored.updated_at, 12.5)
+
+    def test_packed_value_is_small(self):
+        self.assertLess(Session(1, 'app', 1).pack(), 64)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.1)
+
+    def trip(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertGreater(raised.exception.retry_after, 0)
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_allows_single_trial(self):
+        self.trip()
+        time.sleep(0.12)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_trial_success_closes(self):
+        self.trip()
+        time.sleep(0.12)
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_call()
+
+    def test_trial_failure_opens_again(self):
+        self.trip()
+        time.sleep(0.12)
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_healthy_probe_half_opens(self):
+        self.breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=60, probe=lambda: True)
+        self.breaker.record_failure()
+        self.breaker._probe_once()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+
+def make_job(text, seq, kind='send', priority=send_scheduler.NORMAL, **kwargs):
+    return send_scheduler._Job(kind, 1, text, kwargs, priority, seq)
+
+
+class MergeTest(unittest.TestCase):
+    def test_plain_messages_are_joined(self):
+        first, second = make_job('Привет', 1), make_job('Как дела?', 2)
+        merged = send_scheduler._merge(first, second)
+        self.assertEqual(merged.text, 'Привет\n\nКак дела?')
+        self.assertEqual(merged.seq, 1)
+        self.assertEqual(merged.futures, first.futures + second.futures)
+
+    def test_plain_text_is_escaped_when_joined_with_html(self):
+        merged = send_scheduler._merge(make_job('a < b', 1), make_job('<b>жирный</b>', 2, parse_mode='HTML'))
+        self.assertEqual(merged.text, 'a &lt; b\n\n<b>жирный</b>')
+        self.assertEqual(merged.kwargs['parse_mode'], 'HTML')
+
+    def test_incompatible_markup_is_not_merged(self):
+        self.assertIsNone(send_scheduler._merge(make_job('*a*', 1, parse_mode='Markdown'),
+                                                make_job('<b>b</b>', 2, parse_mode='HTML')))
+
+    def test_edits_are_not_merged(self):
+        self.assertIsNone(send_scheduler._merge(make_job('a', 1, kind='edit'), make_job('b', 2)))
+
+    def test_too_long_is_not_merged(self):
+        half = 'x' * (send_scheduler.MAX_MESSAGE_LENGTH // 2)
+        self.assertIsNone(send_scheduler._merge(make_job(half, 1), make_job(half, 2)))
+
+    def test_last_keyboard_and_most_important_priority_win(self):
+        merged = send_scheduler._merge(
+            make_job('a', 1, priority=send_scheduler.NORMAL, reply_markup='first'),
+            make_job('b', 2, priority=send_scheduler.CONFIRMATION, reply_markup='second', disable_web_page_preview=True),
+        )
+        self.assertEqual(merged.kwargs['reply_markup'], 'second')
+        self.assertTrue(merged.kwargs['disable_web_page_preview'])
+        self.assertEqual(merged.priority, send_scheduler.CONFIRMATION)
+
+
+class ChatOrderedExecutorTest(unittest.TestCase):
+    def test_tasks_of_one_chat_run_in_order(self):
+        executor = ChatOrderedExecutor(workers=4, batch_size=3)
+        results = {chat: [] for chat in range(5)}
+        running = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def task(chat, n):
+            with lock:
+                if chat in running:
+                    overlaps.append(chat)
+                running.add(chat)
+            time.sleep(0.001)
+            results[chat].append(n)
+            with lock:
+                running.discard(chat)
+
+        for n in range(20):
+            for chat in results:
+                executor.submit(chat, task, chat, n)
+        executor.shutdown(wait=True)
+
+        self.assertEqual(overlaps, [])
+        for chat, seen in results.items():
+            self.assertEqual(seen, list(range(20)), chat)
+
+    def test_chats_run_concurrently(self):
+        executor = ChatOrderedExecutor(workers=2)
+        both_started = threading.Barrier(2, timeout=2)
+        done = []
+        for chat in (1, 2):
+            executor.submit(chat, lambda chat: done.append(both_started.wait() is not None), chat)
+        executor.shutdown(wait=True)
+        self.assertEqual(done, [True, True])
+
+    def test_failing_task_does_not_stop_the_chat(self):
+        executor = ChatOrderedExecutor(workers=1)
+        seen = []
+        executor.submit(1, lambda: 1 / 0)
+        executor.submit(1, seen.append, 'after')
+        executor.shutdown(wait=True)
+        self.assertEqual(seen, ['after'])
+
+    def test_dispatcher_keeps_chat_order_without_deprecation_warnings(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', TelegramDeprecationWarning)
+            updater = chat_executor.create_updater(FAKE_TOKEN)
+            executor = chat_executor.install(updater.dispatcher, 4)
+
+            results = {chat: [] for chat in (100, 101, 102)}
+
+            def record(update, context):
+                time.sleep(0.001)
+                results[update.effective_chat.id].append(update.update_id)
+
+            updater.dispatcher.add_handler(TypeHandler(Update, record))
+            update_ids = itertools.count(1)
+            for _ in range(10):
+                for chat in results:
+                    data = json.loads(make_update(next(update_ids), chat, 'Да'))
+                    updater.dispatcher.process_update(Update.de_json(data, updater.bot))
+            executor.shutdown(wait=True)
+
+        self.assertEqual([w for w in caught if issubclass(w.category, TelegramDeprecationWarning)], [])
+        for chat, seen in results.items():
+            self.assertEqual(seen, sorted(seen), chat)
+            self.assertEqual(len(seen), 10, chat)
+
+    def test_install_requires_chat_ordered_dispatcher(self):
+        updater = Updater(FAKE_TOKEN, use_context=True)
+        self.assertNotIsInstance(updater.dispatcher, chat_executor.ChatOrderedDispatcher)
+        self.assertIsInstance(updater.dispatcher, Dispatcher)
+        with self.assertRaises(TypeError):
+            chat_executor.install(updater.dispatcher, 2)
+
+
+class LeadDeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'dedup.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_duplicate_within_window(self):
+        dedup = LeadDeduplicator(window=60)
+        self.assertTrue(dedup.check_and_remember(1, '+79991234567'))
+        self.assertFalse(dedup.check_and_remember(1, '+79991234567'))
+        self.assertTrue(dedup.check_and_remember(2, '+79991234567'))
+        dedup.forget(1, '+79991234567')
+        self.assertTrue(dedup.check_and_remember(1, '+79991234567'))
+
+    def test_expired_entry_is_new_again(self):
+        dedup = LeadDeduplicator(window=0.05, path=self.path)
+        self.assertTrue(dedup.check_and_remember(1, '+79991234567'))
+        time.sleep(0.06)
+        self.assertTrue(dedup.check_and_remember(1, '+79991234567'))
+
+    def test_forget_in_another_process_is_seen(self):
+        # Как в кластере: чат ведет один процесс, а заявку забывает процесс с очередью CRM
+        chat_worker = LeadDeduplicator(window=60, path=self.path)
+        outbox_worker = LeadDeduplicator(window=60, path=self.path)
+        self.assertTrue(chat_worker.check_and_remember(1, '+79991234567'))
+        self.assertFalse(outbox_worker.check_and_remember(1, '+79991234567'))
+
+        outbox_worker.forget(1, '+79991234567')
+        self.assertTrue(chat_worker.check_and_remember(1, '+79991234567'))
+        self.assertFalse(chat_worker.check_and_remember(1, '+79991234567'))
+
+    def test_survives_restart(self):
+        LeadDeduplicator(window=60, path=self.path).check_and_remember(1, '+79991234567')
+        restarted = LeadDeduplicator(window=60, path=self.path)
+        self.assertEqual(len(restarted), 1)
+        self.assertFalse(restarted.check_and_remember(1, '+79991234567'))
+
+
+class MemoryConversationsTest(unittest.TestCase):
+    def test_mapping_and_purge(self):
+        conversations = MemoryConversations()
+        conversations[(1, 1)] = 3
+        cutoff = time.time()
+        time.sleep(0.01)
+        conversations[(2, 2)] = 1
+        self.assertEqual(conversations.get((1, 1)), 3)
+        self.assertIsNone(conversations.get((3, 3)))
+        self.assertEqual(conversations.purge_expired(cutoff), 1)
+        self.assertEqual(dict(conversations), {(2, 2): 1})
+
+    def test_survey_schedules_no_job_per_update(self):
+        import main
+        survey = main.build_conversation_handler()
+        self.assertIsNone(survey.conversation_timeout)
+        self.assertIsInstance(survey.conversations, MemoryConversations)
+        self.assertTrue(survey.allow_reentry)
+
+
+class SqliteConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'sessions.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_states_are_shared_between_connections(self):
+        first = StoredConversations(SqliteConversationStore(self.path), 'survey')
+        second = StoredConversations(SqliteConversationStore(self.path), 'survey')
+        first[(42, 42)] = 3
+        self.assertEqual(second[(42, 42)], 3)
+        self.assertEqual(list(second), [(42, 42)])
+        del second[(42, 42)]
+        self.assertNotIn((42, 42), first)
+
+    def test_purge_expired_removes_abandoned_conversations(self):
+        conversations = StoredConversations(SqliteConversationStore(self.path), 'survey')
+        conversations[(1, 1)] = 3
+        cutoff = time.time()
+        time.sleep(0.01)
+        conversations[(2, 2)] = 1
+        self.assertEqual(conversations.purge_expired(cutoff), 1)
+        self.assertEqual(list(conversations), [(2, 2)])
+
+    def test_old_table_gets_timestamps(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE conversations (name TEXT NOT NULL, conv_key TEXT NOT NULL,'
+                     ' state INTEGER NOT NULL, PRIMARY KEY (name, conv_key))')
+        conn.execute("INSERT INTO conversations VALUES ('survey', '[1, 1]', 3)")
+        conn.commit()
+        conn.close()
+
+        conversations = StoredConversations(SqliteConversationStore(self.path), 'survey')
+        # Диалог из старой базы не удаляется сразу, а получает полный срок
+        self.assertEqual(conversations.purge_expired(time.time() - 60), 0)
+        self.assertEqual(conversations.purge_expired(time.time() + 1), 1)
+
+
+class RetryLater(Exception):
+    def __init__(self, retry_after):
+        super().__init__('retry later')
+        self.retry_after = retry_after
+
+
+class CrmOutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'outbox.db')
+        self.outboxes = []
+        self.calls = []
+        self.failed = []
+        # Ответы отправителя по порядку: True/False или исключение; дальше - успех
+        self.answers = []
+
+    def tearDown(self):
+        for outbox in self.outboxes:
+            outbox.stop(timeout=2)
+        self.directory.cleanup()
+
+    def sender(self, phone_number, user_name):
+        self.calls.append((phone_number, user_name))
+        answer = self.answers.pop(0) if self.answers else True
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def make_outbox(self, **kwargs):
+        kwargs.setdefault('base_delay', 0.01)
+        kwargs.setdefault('db_retry_delay', 0.01)
+        outbox = CrmOutbox(self.path, self.sender, workers=1,
+                           on_failed=lambda phone, user_id: self.failed.append((phone, user_id)), **kwargs)
+        self.outboxes.append(outbox)
+        return outbox
+
+    def lead_row(self, outbox):
+        with outbox._lock:
+            return outbox._connect().execute('SELECT status, attempts, last_error FROM leads').fetchone()
+
+    def test_delivered_lead_is_deleted(self):
+        outbox = self.make_outbox()
+        outbox.enqueue('+79991234567', 'Иван', user_id=42)
+        outbox.start()
+        self.assertTrue(wait_for(lambda: outbox.pending_count() == 0))
+        self.assertEqual(self.calls, [('+79991234567', 'Иван')])
+        self.assertIsNone(self.lead_row(outbox))
+
+    def test_retries_until_success(self):
+        self.answers = [False, ValueError('boom'), True]
+        outbox = self.make_outbox()
+        outbox.enqueue('+79991234567', 'Иван')
+        outbox.start()
+        self.assertTrue(wait_for(lambda: outbox.pending_count() == 0))
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.failed, [])
+
+    def test_backoff_grows_and_is_capped(self):
+        outbox = self.make_outbox(base_delay=1.0, max_delay=10.0)
+        for attempts, expected in ((1, 1.0), (2, 2.0), (3, 4.0), (10, 10.0)):
+            delay = outbox._backoff(attempts)
+            self.assertGreaterEqual(delay, expected * 0.8)
+            self.assertLessEqual(delay, expected * 1.2)
+
+    def test_failed_after_max_attempts(self):
+        self.answers = [False] * 3
+        outbox = self.make_outbox(max_attempts=3)
+        outbox.enqueue('+79991234567', 'Иван', user_id=42)
+        outbox.start()
+        self.assertTrue(wait_for(lambda: outbox.failed_count() == 1))
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.lead_row(outbox), ('failed', 3, 'CRM rejected the lead'))
+        self.assertTrue(wait_for(lambda: self.failed == [('+79991234567', 42)]))
+        self.assertEqual(outbox.pending_count(), 0)
+
+    def test_requeue_failed(self):
+        self.answers = [False]
+        outbox = self.make_outbox(max_attempts=1)
+        outbox.enqueue('+79991234567', 'Иван')
+        outbox.start()
+        self.assertTrue(wait_for(lambda: outbox.failed_count() == 1))
+
+        self.assertEqual(outbox.requeue_failed(), 1)
+        self.assertTrue(wait_for(lambda: outbox.pending_count() == 0 and outbox.failed_count() == 0))
+        self.assertEqual(len(self.calls), 2)
+        self.assertIsNone(self.lead_row(outbox))
+
+    def test_sending_leads_are_recovered_on_start(self):
+        crashed = self.make_outbox()
+        crashed.enqueue('+79991234567', 'Иван')
+        with crashed._lock:
+            crashed._connect().execute("UPDATE leads SET status = 'sending'")
+
+        restarted = self.make_outbox()
+        restarted.start()
+        self.assertTrue(wait_for(lambda: restarted.pending_count() == 0))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_retry_after_defers_without_counting_attempt(self):
+        self.answers = [RetryLater(0.05)]
+        outbox = self.make_outbox(max_attempts=1)
+        outbox.enqueue('+79991234567', 'Иван')
+        started = time.monotonic()
+        outbox.start()
+        self.assertTrue(wait_for(lambda: outbox.pending_count() == 0))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(outbox.failed_count(), 0)
+
+    def test_database_errors_do_not_kill_the_worker(self):
+        import sqlite3
+        outbox = self.make_outbox()
+        claim, finish = outbox._claim, outbox._finish
+        errors = {'claim': 1, 'finish': 1}
+
+        def flaky(name, step):
+            def wrapper(*args):
+                if errors[name]:
+                    errors[name] -= 1
+                    raise sqlite3.OperationalError('database is locked')
+                return step(*args)
+            return wrapper
+
+        outbox._claim = flaky('claim', claim)
+        outbox._finish = flaky('finish', finish)
+        outbox.enqueue('+79991234567', 'Иван')
+        outbox.enqueue('+79997654321', 'Петр')
+        outbox.start()
+        self.assertTrue(wait_for(lambda: outbox.pending_count() == 0))
+        # Результат удачной отправки записан после ошибки базы, повторной отправки не было
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(errors, {'claim': 0, 'finish': 0})
+        self.assertTrue(all(thread.is_alive() for thread in outbox._threads))
+
+
+class FormSchemaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeFormServer().start()
+        self.form = SimpleFormHandler(self.server.url + '/form', schema_ttl=60, parser='html.parser')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def expire(self):
+        self.form._schema_fetched_at -= 61
+
+    def test_schema_is_parsed(self):
+        schema = self.form.get_form_schema()
+        self.assertEqual(schema['action'], self.server.url + '/lead')
+        self.assertEqual(schema['phone_field'], 'phone')
+        self.assertEqual(schema['hidden_fields'], {'_token': 'token-1'})
+
+    def test_ttl_hit_skips_request(self):
+        first = self.form.get_form_schema()
+        self.assertIs(self.form.get_form_schema(), first)
+        self.assertEqual(self.server.gets, [200])
+
+    def test_expired_schema_is_revalidated_with_etag(self):
+        first = self.form.get_form_schema()
+        self.expire()
+        self.assertIs(self.form.get_form_schema(), first)
+        self.assertEqual(self.server.gets, [200, 304])
+        # 304 продлевает кеш
+        self.assertIs(self.form.get_form_schema(), first)
+        self.assertEqual(self.server.gets, [200, 304])
+
+    def test_changed_form_is_parsed_again(self):
+        self.form.get_form_schema()
+        self.server.token = 'token-2'
+        self.expire()
+        self.assertEqual(self.form.get_form_schema()['hidden_fields'], {'_token': 'token-2'})
+        self.assertEqual(self.server.gets, [200, 200])
+
+    def test_error_page_keeps_cached_schema(self):
+        first = self.form.get_form_schema()
+        self.server.page_status = 502
+        self.expire()
+        self.assertIs(self.form.get_form_schema(), first)
+        self.assertIs(self.form.get_form_schema(force=True), first)
+
+        self.server.page_status = 200
+        self.server.token = 'token-2'
+        self.assertEqual(self.form.get_form_schema(force=True)['hidden_fields'], {'_token': 'token-2'})
+
+    def test_stale_token_is_refreshed_and_retried(self):
+        for status in (403, 419):
+            with self.subTest(status=status):
+                self.form.get_form_schema()
+                self.server.reject_status = status
+                self.server.token = f'token-{status}'
+                self.assertEqual(self.form.submit_phone_only('+79991234567'), (True, 'Form submitted successfully'))
+                self.assertEqual(self.server.leads[-1], {'_token': f'token-{status}', 'phone': '+79991234567'})
+
+    def test_submit_uses_cached_schema(self):
+        self.form.get_form_schema()
+        self.assertTrue(self.form.submit_phone_only('+79991234567')[0])
+        self.assertEqual(self.server.gets, [200])
+
+
+class RedactPhonesTest(unittest.TestCase):
+    def test_phones_are_masked(self):
+        cases = {
+            'Номер +7 (999) 123-45-67': 'Номер +* (***) ***-**-67',
+            '+79991234567': '+*********67',
+            '89991234567': '*********67',
+            '8 999 123 45 67': '* *** *** ** 67',
+            '7-999-123-45-67': '*-***-***-**-67',
+            '999 123-45-67': '*** ***-**-67',
+            '(999) 123 45 67': '(***) *** ** 67',
+            'contact 79991234567, thanks': 'contact *********67, thanks',
+        }
+        for text, expected in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(log_setup.redact_phones(text), expected)
+
+    def test_ids_and_numbers_stay_unmasked(self):
+        for text in (
+            'user 1234567890 started',
+            'chat_id=5123456789',
+            'update 987654321',
+            'ts 1760810000.123',
+            'took 1760810000123 ms',
+            'order 123-45',
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(log_setup.redact_phones(text), text)
+
+
+class LogPipelineTest(unittest.TestCase):
+    def make_record(self, msg, level=logging.INFO, **extra):
+        record = logging.LogRecord('test', level, __file__, 1, msg, None, None)
+        for name, value in extra.items():
+            setattr(record, name, value)
+        return record
+
+    def test_sampling_filter(self):
+        never = log_setup.SamplingFilter(rate=0.0)
+        self.assertFalse(never.filter(self.make_record('handler', event='handler')))
+        self.assertTrue(never.filter(self.make_record('other event', event='startup')))
+        self.assertTrue(never.filter(self.make_record('no event')))
+        self.assertTrue(never.filter(self.make_record('slow', level=logging.WARNING, event='handler')))
+        self.assertTrue(log_setup.SamplingFilter(rate=1.0).filter(self.make_record('handler', event='handler')))
+
+    def test_json_formatter_fields(self):
+        record = self.make_record('Заявка от +79991234567', update_id=7, chat_id=42, state='phone', duration_ms=1.5)
+        data = json.loads(log_setup.JsonFormatter().format(record))
+        self.assertEqual(data['msg'], 'Заявка от +*********67')
+        self.assertEqual((data['update_id'], data['chat_id'], data['state'], data['duration_ms']), (7, 42, 'phone', 1.5))
+        self.assertEqual((data['level'], data['logger']), ('INFO', 'test'))
+        self.assertNotIn('event', data)
+
+    def test_handler_context_reaches_records(self):
+        stream = io.StringIO()
+        log_setup.setup_logging(level='INFO', fmt='json', stream=stream)
+        try:
+            @log_setup.handler_context('gps')
+            def handler(update, context):
+                logging.getLogger('test.handler').info("inside")
+
+            update = type('FakeUpdate', (), {'update_id': 11, 'effective_chat': type('Chat', (), {'id': 42})()})()
+            handler(update, None)
+        finally:
+            log_setup.shutdown_logging()
+            logging.getLogger().handlers.clear()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        inside = next(record for record in records if record['msg'] == 'inside')
+        self.assertEqual((inside['update_id'], inside['chat_id'], inside['state']), (11, 42, 'gps'))
+        finished = next(record for record in records if record.get('event') == 'handler')
+        self.assertIn('duration_ms', finished)
+        # Контекст не утекает за пределы обработчика
+        self.assertEqual(log_setup.get_context(), {})
+
+
+class UpdateRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'recording.jsonl')
+        self.recorder = UpdateRecorder(self.path)
+
+    def tearDown(self):
+        self.recorder.close()
+        self.directory.cleanup()
+
+    def test_pseudonym_keeps_shape_and_validity(self):
+        from main import validate_phone_number
+        for phone in ('+79991234567', '89991234567', '+7 (999) 123-45-67', '999 123-45-67', '79991234567'):
+            with self.subTest(phone=phone):
+                pseudonym = self.recorder.pseudonymize_phone(phone)
+                self.assertNotEqual(pseudonym, phone)
+                self.assertEqual(len(pseudonym), len(phone))
+                self.assertEqual([ch.isdigit() for ch in pseudonym], [ch.isdigit() for ch in phone])
+                self.assertEqual([ch for ch in pseudonym if not ch.isdigit()], [ch for ch in phone if not ch.isdigit()])
+                self.assertEqual(pseudonym.lstrip('+ (')[0], phone.lstrip('+ (')[0])
+                self.assertIsNotNone(validate_phone_number(pseudonym))
+
+    def test_pseudonym_is_stable_within_recording_only(self):
+        phone = '+79991234567'
+        self.assertEqual(self.recorder.pseudonymize_phone(phone), self.recorder.pseudonymize_phone(phone))
+        self.assertNotEqual(self.recorder.pseudonymize_phone(phone), self.recorder.pseudonymize_phone('+79991234568'))
+        other = UpdateRecorder(os.path.join(self.directory.name, 'other.jsonl'))
+        try:
+            # Соль случайная: по псевдониму из другой записи номер не сопоставить
+            self.assertNotEqual(other.pseudonymize_phone(phone), self.recorder.pseudonymize_phone(phone))
+        finally:
+            other.close()
+
+    def test_scrub(self):
+        data = {
+            'update_id': 1,
+            'message': {
+                'text': 'Мой номер 8 999 123-45-67, звоните',
+                'from': {'id': 1234567890, 'first_name': 'Иван'},
+                'contact': {'phone_number': '79991234567', 'user_id': 1234567890},
+                'entities': [{'type': 'phone_number', 'offset': 10, 'length': 15}],
+            },
+        }
+        scrubbed = self.recorder._scrub(data)
+        message = scrubbed['message']
+        self.assertNotIn('999 123-45-67', message['text'])
+        self.assertTrue(message['text'].startswith('Мой номер 8 '))
+        self.assertTrue(message['text'].endswith(', звоните'))
+        self.assertEqual(message['contact']['phone_number'],
+                         self.recorder.pseudonymize_phone('79991234567'))
+        # id и имена остаются как есть, исходный словарь не меняется
+        self.assertEqual(message['from'], {'id': 1234567890, 'first_name': 'Иван'})
+        self.assertEqual(message['entities'], data['message']['entities'])
+        self.assertEqual(data['message']['contact']['phone_number'], '79991234567')
+
+    def test_recorded_file_reads_back(self):
+        import replay
+        from telegram import Update
+        update = Update.de_json(json.loads(make_update(5, 42, '+7 999 123 45 67')), None)
+        self.recorder.record_update(update)
+        self.recorder.record_crm(200, 0.1)
+        self.recorder.record_crm(None, 0.2)
+
+        updates, crm_responses = replay.read_recording(self.path)
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]['update_id'], 5)
+        self.assertNotEqual(updates[0]['message']['text'], '+7 999 123 45 67')
+        self.assertEqual(crm_responses, [200, None])
+
+
+class ReplayTest(unittest.TestCase):
+    def test_fixture_recording_round_trip(self):
+        # Отдельный процесс: replay подменяет обработчики и транспорт CRM в модуле main
+        with tempfile.TemporaryDirectory() as directory:
+            report_path = os.path.join(directory, 'report.json')
+            subprocess.run(
+                [sys.executable, 'replay.py', os.path.join(FIXTURES, 'recording.jsonl'), '--json', report_path],
+                cwd=os.path.dirname(os.path.abspath(__file__)), check=True, capture_output=True, timeout=60
+            )
+            with open(report_path, encoding='utf-8') as f:
+                report = json.load(f)
+
+        self.assertEqual((report['updates'], report['leads'], report['crm_rejected']), (10, 2, 0))
+        # Два опроса по 6 сообщений: приветствие, три вопроса, рекомендация и подтверждение
+        self.assertEqual(report['messages_sent'], 12)
+        for name in ('start', 'autostart_choice', 'control_choice', 'gps_choice', 'get_phone', 'send_to_crm'):
+            self.assertEqual(report['handlers'][name]['calls'], 2, name)
+
+
+class MemoryGuardTest(unittest.TestCase):
+    def make_guard(self, shed_cooldown=600.0):
+        # Лимит в 1 байт заведомо превышен: каждый замер выше soft_limit
+        guard = MemoryGuard(soft_limit=1, shed_cooldown=shed_cooldown)
+        guard.sheds = []
+        guard.add_shedder('counter', lambda: guard.sheds.append(1) or 1)
+        return guard
+
+    def test_sheds_once_until_rearmed(self):
+        guard = self.make_guard()
+        guard.sample()
+        guard.sample()
+        guard.sample()
+        self.assertEqual(len(guard.sheds), 1)
+
+        # RSS опустился ниже rearm_ratio * soft_limit - следующее превышение снова сбрасывает кеши
+        guard.soft_limit = 1 << 50
+        guard.sample()
+        guard.soft_limit = 1
+        guard.sample()
+        self.assertEqual(len(guard.sheds), 2)
+
+    def test_sheds_again_after_cooldown(self):
+        guard = self.make_guard(shed_cooldown=0.05)
+        guard.sample()
+        guard.sample()
+        self.assertEqual(len(guard.sheds), 1)
+        time.sleep(0.1)
+        guard.sample()
+        self.assertEqual(len(guard.sheds), 2)
+
+    def test_render_without_samples_does_not_shed(self):
+        guard = self.make_guard()
+        self.assertIn('Замеров еще не было', guard.render())
+        self.assertEqual(guard.sheds, [])
+
+        guard.sample()
+        self.assertIn('RSS', guard.render())
+        self.assertEqual(len(guard.sheds), 1)
+
+    def test_main_does_not_load_optional_modules(self):
+        code = (
+            "import sys, main; "
+            "print(sorted(m for m in ('cluster', 'webhook_server', 'catalog_sync', 'memory_guard') if m in sys.modules))"
+        )
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=dict(os.environ, BOT_TOKEN=FAKE_TOKEN))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip().splitlines()[-1], '[]')
+
+
+class SurveyRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.router = SurveyRouter()
+        self.router.add_buttons(0, {'Да': True, 'Нет': False}, self.callback)
+        self.router.add_buttons(1, {'Да': 'yes'}, self.callback)
+
+    def callback(self, update, context, answer):
+        self.calls.append((update.message.text, answer))
+        return 'next'
+
+    @staticmethod
+    def update(text, update_id=1):
+        return Update.de_json(json.loads(make_update(update_id, 100, text)), None)
+
+    def test_decoded_answer_is_passed_to_callback(self):
+        handler = self.router.handler(0)
+        update = self.update('Нет')
+        check = handler.check_update(update)
+        self.assertTrue(check)
+        self.assertEqual(handler.handle_update(update, None, check), 'next')
+        self.assertEqual(self.calls, [('Нет', False)])
+
+    def test_same_text_is_decoded_per_state(self):
+        update = self.update('Да')
+        self.assertEqual(self.router.handler(0).check_update(update)[1], True)
+        self.assertEqual(self.router.handler(1).check_update(update)[1], 'yes')
+
+    def test_unknown_text_is_ignored(self):
+        handler = self.router.handler(0)
+        self.assertFalse(handler.check_update(self.update('да')))
+        self.assertFalse(handler.check_update(self.update('Может быть')))
+        self.assertFalse(self.router.handler(2).check_update(self.update('Да')))
+
+    def test_non_message_updates_are_ignored(self):
+        handler = self.router.handler(0)
+        edited = json.loads(make_update(2, 100, 'Да'))
+        edited['edited_message'] = edited.pop('message')
+        callback_query = {
+            'update_id': 3,
+            'callback_query': {
+                'id': '1', 'chat_instance': '1', 'data': 'Да',
+                'from': {'id': 100, 'is_bot': False, 'first_name': 'User'},
+            },
+        }
+        self.assertFalse(handler.check_update(Update.de_json(edited, None)))
+        self.assertFalse(handler.check_update(Update.de_json(callback_query, None)))
+        self.assertFalse(handler.check_update('Да'))
+        self.assertFalse(handler.check_update(None))
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import hmac
+import json
+import os
+import re
+import threading
+import time
+
+# Все, что похоже на номер телефона в тексте сообщения (пользователь вводит номер вручную)
+PHONE_LIKE_RE = re.compile(r'\+?\d[\d\s\-()]{8,}\d')
+
+
+class UpdateRecorder:
+    """Дописывает события в файл для replay.py: {"k": "u", ...} - обновление, {"k": "c", ...} - ответ CRM.
+
+    Номера телефонов (контакт и введенные вручную) заменяются псевдонимами
+    той же формы: первая цифра и разделители сохраняются, остальные цифры
+    выводятся из HMAC со случайной солью записи. Один номер внутри записи
+    всегда дает один псевдоним, поэтому воспроизведение идет тем же путем,
+    но исходный номер из файла не восстановить. Имена, username и id
+    пользователей остаются в записи как есть - это персональные данные,
+    храните записи соответственно.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def pseudonymize_phone(self, value):
+        digits = ''.join(ch for ch in value if ch.isdigit())
+        digest = hmac.new(self._salt, digits.encode(), 'sha256').hexdigest()
+        replacement = iter(str(int(digest, 16)))
+        result = []
+        first = True
+        for ch in value:
+            if ch.isdigit():
+                result.append(ch if first else next(replacement))
+                first = False
+            else:
+                result.append(ch)
+        return ''.join(result)
+
+    def _scrub(self, data):
+        if isinstance(data, dict):
+            scrubbed = {}
+            for key, value in data.items():
+                if key == 'phone_number' and isinstance(value, str):
+                    scrubbed[key] = self.pseudonymize_phone(value)
+                elif key in ('text', 'caption') and isinstance(value, str):
+                    scrubbed[key] = PHONE_LIKE_RE.sub(lambda match: self.pseudonymize_phone(match.group(0)), value)
+                else:
+                    scrubbed[key] = self._scrub(value)
+            return scrubbed
+        if isinstance(data, list):
+            return [self._scrub(item) for item in data]
+        return data
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def record_update(self, update, context=None):
+        """Callback для TypeHandler: сохраняет обновление с псевдонимами вместо телефонов"""
+        self._write({'k': 'u', 't': round(time.time(), 3), 'd': self._scrub(update.to_dict())})
+
+    def record_crm(self, status, duration):
+        """status - HTTP-код ответа или None, если запрос завершился исключением"""
+        self._write({'k': 'c', 't': round(time.time(), 3), 's': status, 'ms': round(duration * 1000, 1)})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,163 @@
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Встроенный HTTP-сервер, принимающий обновления Telegram.
+
+    Обновление из POST-запроса сразу кладется в очередь диспетчера,
+    а Telegram получает ответ без ожидания обработчиков. Дополнительно
+    отдает /healthz (процесс жив) и /readyz (вебхук установлен). Метрики
+    и отладочные страницы здесь не отдаются: порт вебхука открыт наружу,
+    они доступны только на сервере метрик (METRICS_PORT).
+    """
+
+    def __init__(self, bot, update_queue, listen='0.0.0.0', port=8080, url_path='telegram', secret_token=None):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+        self.ready = threading.Event()
+
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def server_port(self):
+        """Фактический порт (удобно при port=0 в тестах)"""
+        return self._httpd.server_address[1] if self._httpd else self.port
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.listen, self.port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='webhook-server', daemon=True)
+        self._thread.start()
+        logger.info("🌐 Вебхук слушает %s:%s%s", self.listen, self.server_port, self.url_path)
+
+    def stop(self):
+        self.ready.clear()
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def check_secret(self, value):
+        if not self.secret_token:
+            return True
+        if value is None:
+            return False
+        # compare_digest не принимает строки с не-ASCII символами - сравниваем байты заголовка как есть
+        return hmac.compare_digest(value.encode('latin-1', 'replace'), self.secret_token.encode('utf-8'))
+
+    def handle_update(self, body):
+        """Разбирает тело запроса и передает обновление диспетчеру; ValueError - тело не обновление"""
+        data = json.loads(body)
+        if not isinstance(data, dict) or 'update_id' not in data:
+            raise ValueError('not a Telegram update')
+        try:
+            update = Update.de_json(data, self.bot)
+        except (TypeError, KeyError, AttributeError) as e:
+            # Корректный JSON, но объекты внутри не той формы, например {"message": {}}
+            raise ValueError(f'malformed update: {e!r}') from e
+        if update is not None:
+            self.update_queue.put(update)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, status, body=b''):
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/healthz':
+                    self._reply(200, b'ok')
+                elif self.path == '/readyz':
+                    if server.ready.is_set():
+                        self._reply(200, b'ready')
+                    else:
+                        self._reply(503, b'not ready')
+                else:
+                    self._reply(404)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+
+                if self.path != server.url_path:
+                    self._reply(404)
+                    return
+                if not server.check_secret(self.headers.get(SECRET_HEADER)):
+                    logger.warning("⚠️ Вебхук: неверный секретный токен от %s", self.client_address[0])
+                    self._reply(403)
+                    return
+
+                try:
+                    server.handle_update(body)
+                except ValueError as e:
+                    logger.warning("⚠️ Вебхук: некорректное обновление: %s", e)
+                    self._reply(400)
+                    return
+                self._reply(200)
+
+            def log_message(self, format, *args):
+                logger.debug("webhook %s - %s", self.address_string(), format % args)
+
+        return Handler
+
+
+def run_webhook(updater, webhook_url, listen='0.0.0.0', port=8080, url_path='telegram', secret_token=None):
+    """Запускает бота в режиме вебхука и блокируется до SIGINT/SIGTERM"""
+    dispatcher = updater.dispatcher
+    server = WebhookServer(updater.bot, dispatcher.update_queue, listen, port, url_path, secret_token)
+    server.start()
+
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+    dispatcher_thread.start()
+    updater.job_queue.start()
+
+    api_kwargs = {'secret_token': secret_token} if secret_token else None
+    updater.bot.set_webhook(url=webhook_url.rstrip('/') + server.url_path, api_kwargs=api_kwargs)
+    server.ready.set()
+    logger.info("✅ Вебхук установлен: %s", webhook_url)
+
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        stopped.set()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, stop)
+    while not stopped.wait(1):
+        pass
+
+    logger.info("🛑 Остановка вебхука...")
+    server.stop()
+    updater.job_queue.stop()
+    dispatcher.stop()
+    dispatcher_thread.join(timeout=10)
+    if dispatcher.persistence:
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()